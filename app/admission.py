@@ -0,0 +1,164 @@
+import asyncio
+import collections
+import math
+import time
+from typing import AsyncIterator
+
+from fastapi import HTTPException, status
+from prometheus_client import Counter, Gauge, Histogram
+
+from app.resilience import remaining
+
+
+#
+# Admission control of expensive endpoints
+#
+# A limiter lets a fixed number of requests run at the same time (per api
+# worker) and queues a bounded number of others in arrival order. When the
+# queue is full, or a queued request waits too long, it is shed right away
+# with a 503 instead of piling up behind the running ones:
+#
+#   route_admission = AdmissionLimiter('request_route', ...)
+#
+#   @router.get('/...', dependencies=[Depends(route_admission)])
+#
+
+ADMITTED = Counter(
+    "app_admission_admitted_total",
+    "Total count of requests admitted by route.",
+    ["route", "app_name"],
+)
+SHED = Counter(
+    "app_admission_shed_total",
+    "Total count of requests shed by route and reason.",
+    ["route", "reason", "app_name"],
+)
+QUEUE_WAIT = Histogram(
+    "app_admission_queue_wait_seconds",
+    "Histogram of time admitted requests waited for a slot by route (in seconds)",
+    ["route", "app_name"],
+)
+IN_FLIGHT = Gauge(
+    "app_admission_in_flight",
+    "Number of admitted requests currently running by route.",
+    ["route", "app_name"],
+    multiprocess_mode="livesum",
+)
+QUEUED = Gauge(
+    "app_admission_queued",
+    "Number of requests currently waiting for a slot by route.",
+    ["route", "app_name"],
+    multiprocess_mode="livesum",
+)
+
+
+class AdmissionLimiter:
+    def __init__(
+        self,
+        name: str,
+        app_name: str,
+        max_concurrency: int,
+        max_queued: int,
+        queue_timeout: float,
+        retry_after: float = 1.0,
+    ) -> None:
+        self.name = name
+        self.app_name = app_name
+        # 0 = unlimited
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._active = 0
+        # waiters in arrival order, a released slot is handed to the first one
+        self._queue: 'collections.deque[asyncio.Future]' = collections.deque()
+        self._admitted = ADMITTED.labels(route=name, app_name=app_name)
+        self._queue_wait = QUEUE_WAIT.labels(route=name, app_name=app_name)
+        self._in_flight = IN_FLIGHT.labels(route=name, app_name=app_name)
+        self._queued = QUEUED.labels(route=name, app_name=app_name)
+
+    def _shed(self, reason: str) -> HTTPException:
+        SHED.labels(route=self.name, reason=reason, app_name=self.app_name).inc()
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail='Server is busy, try again later',
+            headers={'Retry-After': str(max(1, math.ceil(self.retry_after)))},
+        )
+
+    def _release(self) -> None:
+        while self._queue:
+            waiter = self._queue.popleft()
+            self._queued.dec()
+            if not waiter.done():
+                # the slot goes to the next waiter, nothing to count
+                waiter.set_result(None)
+                return
+
+        self._active -= 1
+        self._in_flight.dec()
+
+    def _abandon(self, waiter: asyncio.Future) -> None:
+        if waiter.done():
+            # got a slot right as it gave up, pass it on
+            self._release()
+        else:
+            waiter.cancel()
+            self._queue.remove(waiter)
+            self._queued.dec()
+
+    async def acquire(self) -> None:
+        if not self.max_concurrency:
+            self._admitted.inc()
+            self._in_flight.inc()
+            self._active += 1
+            return
+
+        if self._active < self.max_concurrency and not self._queue:
+            self._admitted.inc()
+            self._queue_wait.observe(0)
+            self._in_flight.inc()
+            self._active += 1
+            return
+
+        if len(self._queue) >= self.max_queued:
+            raise self._shed('queue_full')
+
+        # never wait longer than the request has left
+        timeout = self.queue_timeout
+        left = remaining()
+        if left is not None:
+            timeout = min(timeout, left)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue.append(waiter)
+        self._queued.inc()
+        start = time.perf_counter()
+        try:
+            done, _ = await asyncio.wait((waiter,), timeout=max(0, timeout))
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+        if not done:
+            self._abandon(waiter)
+            raise self._shed('queue_timeout')
+
+        # the slot was handed over by _release, _active already counts it
+        self._admitted.inc()
+        self._queue_wait.observe(time.perf_counter() - start)
+
+    def release(self) -> None:
+        if not self.max_concurrency:
+            self._active -= 1
+            self._in_flight.dec()
+            return
+
+        self._release()
+
+    # FastAPI dependency, the slot is held until the response is sent
+    async def __call__(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
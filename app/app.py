@@ -1,8 +1,9 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 
 from app.config import Settings, get_settings
+from app.pagination import NEXT_CURSOR_HEADER
 
 settings: Settings = get_settings()
 
@@ -26,8 +27,31 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=['*'],
     allow_headers=['*'],
+    # let browsers read the pagination cursor
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
+# shared outbound http client
+from app.http_client import start_http_client, close_http_client
+
+
+@app.on_event('startup')
+def open_http_client():
+    start_http_client(settings)
+
+
+@app.on_event('shutdown')
+async def shutdown_http_client():
+    await close_http_client()
+
+# token verification keys
+from app.auth import load_verification_keys
+
+
+@app.on_event('startup')
+def load_auth_keys():
+    load_verification_keys(settings)
+
 # stores router
 from app.routers import stores
 app.include_router(stores.router)
@@ -36,6 +60,55 @@ app.include_router(stores.router)
 from app.routers import packets
 app.include_router(packets.router)
 
+# db indexes (declared by the modules above), built in the background
+import asyncio
+from app.indexes import create_indexes
+
+background_tasks = set()
+
+
+@app.on_event('startup')
+def start_create_indexes():
+    task = asyncio.create_task(create_indexes())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+# route optimizer worker pool
+from app.optimizer.service import ClientDisconnected, optimizer_service
+
+
+@app.on_event('startup')
+def start_optimizer():
+    optimizer_service.start(settings)
+
+
+@app.on_event('shutdown')
+def stop_optimizer():
+    optimizer_service.shutdown()
+
+
+# client closed the connection while its route was being planned (nginx style
+# 499, nobody reads it, it only keeps it out of the error logs and 5xx metrics)
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request: Request, exc: ClientDisconnected):
+    return Response(status_code=499)
+
+# route planning job workers
+
+
+@app.on_event('startup')
+def start_route_jobs():
+    packets.route_jobs.start()
+
+
+# shutdown handlers run in registration order, the workers stop first while
+# the optimizer pool and http client they use are still there
+async def stop_route_jobs():
+    await packets.route_jobs.stop()
+
+
+app.router.on_shutdown.insert(0, stop_route_jobs)
+
 
 @app.get('/', response_class=HTMLResponse)
 async def root(request: Request):
@@ -72,12 +145,37 @@ def health():
 # Metrics, Traces
 #
 
-from app.utils import PrometheusMiddleware, metrics, setting_otlp
+from app.utils import (PrometheusMiddleware, mark_metrics_process_dead,
+                       metrics, setting_otlp, start_otlp, stop_otlp)
 
 # Metrics middleware
 app.add_middleware(PrometheusMiddleware, app_name=settings.app_name)
 app.add_route('/metrics', metrics)
 
+# request budget of outbound calls (app.resilience)
+from app.resilience import DeadlineMiddleware
+app.add_middleware(DeadlineMiddleware, timeout=settings.request_timeout)
+
 # OpenTelemetry exporter
-setting_otlp(app, settings.app_name, settings.api_trace_url)
+setting_otlp(app, settings.app_name, settings.api_trace_url, excluded_urls=settings.trace_excluded_urls)
+
+
+# per worker process: tracer provider / exporter thread, metric files
+@app.on_event('startup')
+def start_telemetry():
+    start_otlp(
+        settings.app_name,
+        settings.api_trace_url,
+        sample_ratio=settings.trace_sample_ratio,
+        sample_errors=settings.trace_sample_errors,
+        max_queue_size=settings.trace_max_queue_size,
+        max_export_batch_size=settings.trace_max_export_batch_size,
+        schedule_delay_millis=settings.trace_schedule_delay_millis,
+    )
+
+
+@app.on_event('shutdown')
+def stop_telemetry():
+    stop_otlp()
+    mark_metrics_process_dead()
 
@@ -1,11 +1,18 @@
 from fastapi import Depends, HTTPException, status, Header
 from fastapi.security import OAuth2PasswordBearer
 
+import hashlib
+import json
+import time
+
 from jose import JWTError, jwt
+from jose.exceptions import ExpiredSignatureError, JWTClaimsError
 
 from app.models.jwt import *
 from app.models.users import *
 from app.config import Settings, get_settings
+from app.instrumentation import stage
+from app.cache import TTLCache
 
 
 # auth scheme
@@ -19,19 +26,95 @@ credentials_exception = HTTPException(
 )
 
 
+def token_cache_key(token: str) -> str:
+    # do not keep raw tokens around as cache keys
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+#
+# Token verification
+#
+# Accepted keys: api_secret_key, the previous secrets still valid during a
+# rotation, and the keys of an optional JWKS file. Verified claims are cached
+# by token hash until the token expires, so repeated requests with the same
+# token skip signature verification.
+#
+
+_verification_keys: list | None = None
+
+# verified claims by token hash
+claims_cache = TTLCache(
+    'jwt_claims',
+    max_size=get_settings().auth_token_cache_size,
+    ttl=get_settings().auth_token_cache_ttl,
+    app_name=get_settings().app_name,
+)
+
+
+def load_verification_keys(settings: Settings) -> list:
+    global _verification_keys
+
+    keys = [settings.api_secret_key, *settings.api_previous_secret_keys]
+    if settings.api_jwks_file:
+        with open(settings.api_jwks_file) as f:
+            keys.extend(json.load(f)['keys'])
+
+    _verification_keys = keys
+    return keys
+
+
+def decode_token(token: str, settings: Settings) -> dict:
+    keys = _verification_keys if _verification_keys is not None else load_verification_keys(settings)
+
+    error = JWTError('No verification keys')
+    for key in keys:
+        try:
+            return jwt.decode(token, key, algorithms=[settings.api_jwt_algorithm])
+        except (ExpiredSignatureError, JWTClaimsError):
+            # the signature matched, the claims are invalid
+            raise
+        except JWTError as e:
+            # signed with another key, try the next one
+            error = e
+
+    raise error
+
+
+def verify_token(token: str, settings: Settings) -> dict:
+    key = token_cache_key(token)
+    payload = claims_cache.get(key)
+    if payload is not None:
+        return payload
+
+    with stage('jwt_verify'):
+        payload = decode_token(token, settings)
+
+    # never past the expiry, tokens without one are cached for the default ttl
+    exp = payload.get('exp')
+    claims_cache.set(key, payload, None if exp is None else exp - time.time())
+
+    return payload
+
+
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
     settings: Settings = Depends(get_settings),
 ):
     # verify user credentials
     try:
-        payload = jwt.decode(token, settings.api_secret_key, algorithms=[settings.api_jwt_algorithm])
+        payload = verify_token(token, settings)
         username: str = payload.get('sub')
         user_id: str = payload.get('user_id')
         if username is None or user_id is None:
             raise credentials_exception
         
-        return JWTokenData(username=username, user_id=user_id)
+        return JWTokenData(
+            username=username,
+            user_id=user_id,
+            exp=payload.get('exp'),
+            is_customer=payload.get('is_customer'),
+            is_delivery_person=payload.get('is_delivery_person'),
+        )
     except JWTError:
         raise credentials_exception
     
@@ -39,35 +122,90 @@ async def get_current_user(
     raise credentials_exception
 
 
-import httpx
 from opentelemetry.propagate import inject
 
+from app.resilience import Upstream
+
+
+# user profiles by token hash, shared by concurrent requests with the same token
+profile_cache = TTLCache(
+    'auth_profile',
+    max_size=get_settings().auth_profile_cache_size,
+    ttl=get_settings().auth_profile_cache_ttl,
+    app_name=get_settings().app_name,
+)
+
+auth_upstream = Upstream(
+    'auth',
+    app_name=get_settings().app_name,
+    failure_threshold=get_settings().upstream_breaker_failures,
+    reset_timeout=get_settings().upstream_breaker_reset,
+    retries=get_settings().auth_retries,
+    retry_delay=get_settings().upstream_retry_delay,
+    hedge_delay=get_settings().auth_hedge_delay,
+)
+
+
+@stage('auth_profile')
+async def fetch_user_profile(authorization: str | None, settings: Settings) -> UserRead:
+    # create headers
+    headers = {'Authorization': authorization}
+
+    # inject trace info to header
+    inject(headers)
+
+    response = await auth_upstream.get(
+        f'{settings.auth_server}/users/my_profile',
+        headers=headers,
+    )
+
+    if response.status_code == 200:
+        return UserRead.parse_raw(response.content)
+    if response.status_code == 401:
+        raise credentials_exception
+
+    raise Exception('Error while communicating with the auth server.')
+
 
 # get user data from the suth server
 async def get_current_user_data(
     # ensure authorised
     token: JWTokenData = Depends(get_current_user),
+    raw_token: str = Depends(oauth2_scheme),
     # to forward token
     authorization: str | None = Header(default=None, include_in_schema=False),
     # site settings
     settings: Settings = Depends(get_settings),
 ) -> UserRead:
-    # create headers
-    headers = {'Authorization': authorization}
+    # never keep a profile past the token expiry
+    ttl = None if token.exp is None else token.exp - time.time()
 
-    # inject trace info to header
-    inject(headers)
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f'{settings.auth_server}/users/my_profile',
-            headers=headers,
+    return await profile_cache.get_or_load(
+        token_cache_key(raw_token),
+        lambda: fetch_user_profile(authorization, settings),
+        ttl=ttl,
+    )
+
+
+# get user roles, from the token claims if allowed (no auth server round trip)
+async def get_current_user_roles(
+    token: JWTokenData = Depends(get_current_user),
+    raw_token: str = Depends(oauth2_scheme),
+    authorization: str | None = Header(default=None, include_in_schema=False),
+    settings: Settings = Depends(get_settings),
+) -> UserRoles:
+    if settings.auth_roles_from_claims \
+            and token.is_customer is not None \
+            and token.is_delivery_person is not None:
+        return UserRoles(
+            is_customer=token.is_customer,
+            is_delivery_person=token.is_delivery_person,
         )
 
-        if response.status_code == 200:
-            user_data_str = response.read()
-            return UserRead.parse_raw(user_data_str)
-        if response.status_code == 401:
-            raise credentials_exception
-    
-    raise Exception('Error while communicating with the auth server.')
+    # token without role claims, fall back to the full profile
+    user_data = await get_current_user_data(token, raw_token, authorization, settings)
+
+    return UserRoles(
+        is_customer=user_data.is_customer,
+        is_delivery_person=user_data.is_delivery_person,
+    )
@@ -0,0 +1,68 @@
+import asyncio
+from typing import TYPE_CHECKING
+
+from pymongo.errors import BulkWriteError, WriteError
+
+if TYPE_CHECKING:
+    from motor.motor_asyncio import AsyncIOMotorCollection
+
+
+class InsertCoalescer:
+    """Group commit for single-document inserts.
+
+    Inserts arriving within `window` seconds (or until `max_batch` are waiting)
+    are written with one unordered insert_many. Every caller gets its own
+    outcome: None, or the error of its document.
+    """
+
+    def __init__(self, collection: 'AsyncIOMotorCollection', window: float, max_batch: int) -> None:
+        self.collection = collection
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        # running writes (keeps a reference to the tasks)
+        self._writes: set[asyncio.Task] = set()
+
+    async def insert(self, document: dict) -> None:
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        self._pending.append((document, result))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        await result
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        errors: dict[int, BaseException] = {}
+        try:
+            await self.collection.insert_many([document for document, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            # unordered: only the listed documents were not written
+            for error in e.details.get('writeErrors', []):
+                errors[error['index']] = WriteError(error.get('errmsg'), error.get('code'), error)
+        except Exception as e:
+            errors = {i: e for i in range(len(batch))}
+
+        for i, (_, result) in enumerate(batch):
+            # the caller may have gone away (cancelled request)
+            if result.done():
+                continue
+            if i in errors:
+                result.set_exception(errors[i])
+            else:
+                result.set_result(None)
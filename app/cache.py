@@ -0,0 +1,215 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from prometheus_client import Counter, Gauge
+from pymongo import ReturnDocument
+
+
+CACHE_HITS = Counter(
+    "app_cache_hits_total", "Total count of cache hits by cache name.", [
+        "cache", "app_name"]
+)
+CACHE_MISSES = Counter(
+    "app_cache_misses_total", "Total count of cache misses by cache name.", [
+        "cache", "app_name"]
+)
+CACHE_EVICTIONS = Counter(
+    "app_cache_evictions_total",
+    "Total count of cache evictions by cache name and reason (expired, size, invalidated).",
+    ["cache", "reason", "app_name"],
+)
+CACHE_COALESCED = Counter(
+    "app_cache_coalesced_total",
+    "Total count of cache loads that joined an already running load.",
+    ["cache", "app_name"],
+)
+CACHE_SIZE = Gauge(
+    "app_cache_size", "Number of entries currently held by the cache.", [
+        "cache", "app_name"],
+    multiprocess_mode="livesum",
+)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """In-process LRU cache with per-entry expiry and single-flight loading.
+
+    A `max_size` of 0 disables caching (loads are still coalesced). With a
+    `weigh` function `max_size` caps the total weight of the values instead
+    of their number.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: float, app_name: str,
+                 weigh: Callable[[Any], int] | None = None) -> None:
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.weigh = weigh
+        # key -> (expires_at, value), oldest first
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._weights: dict[Hashable, int] = {}
+        self._weight = 0
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        # bumped by invalidate(), loads started before it are not cached
+        self._generation = 0
+
+        self._hits = CACHE_HITS.labels(cache=name, app_name=app_name)
+        self._misses = CACHE_MISSES.labels(cache=name, app_name=app_name)
+        self._coalesced = CACHE_COALESCED.labels(cache=name, app_name=app_name)
+        self._size = CACHE_SIZE.labels(cache=name, app_name=app_name)
+        self._evictions = {
+            reason: CACHE_EVICTIONS.labels(cache=name, reason=reason, app_name=app_name)
+            for reason in ('expired', 'size', 'invalidated')
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self._hits.inc()
+                return value
+
+            self._remove(key, 'expired')
+
+        self._misses.inc()
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if self.max_size <= 0 or ttl <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        self._reweigh(key, value)
+
+    def resize(self, key: Hashable) -> None:
+        # weigh a value again that was changed in place (e.g. a growing dict)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._reweigh(key, entry[1])
+
+    def _reweigh(self, key: Hashable, value: Any) -> None:
+        weight = self.weigh(value) if self.weigh is not None else 1
+        self._weight += weight - self._weights.get(key, 0)
+        self._weights[key] = weight
+        while self._weight > self.max_size and self._entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._weight -= self._weights.pop(evicted)
+            self._evictions['size'].inc()
+        self._size.set(len(self._entries))
+
+    def invalidate(self, key: Hashable = _MISSING) -> None:
+        # no key clears the whole cache, running loads may have read the old
+        # data, later callers start a new one
+        self._generation += 1
+        if key is _MISSING:
+            self._inflight.clear()
+            self._evictions['invalidated'].inc(len(self._entries))
+            self._entries.clear()
+            self._weights.clear()
+            self._weight = 0
+            self._size.set(0)
+        else:
+            self._inflight.pop(key, None)
+            if key in self._entries:
+                self._remove(key, 'invalidated')
+
+    def _remove(self, key: Hashable, reason: str) -> None:
+        del self._entries[key]
+        self._weight -= self._weights.pop(key)
+        self._evictions[reason].inc()
+        self._size.set(len(self._entries))
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: Callable[[Any], float | None] | float | None = None,
+    ) -> Any:
+        """Return the cached value or load it, concurrent misses share one load.
+
+        `ttl` may be a callable computing the entry lifetime from the loaded value.
+        Failed loads are not cached, every waiter receives the exception.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        load = self._inflight.get(key)
+        if load is not None:
+            self._coalesced.inc()
+        else:
+            # run the load as its own task so a cancelled caller does not
+            # cancel it for everyone else waiting on the same key
+            load = asyncio.ensure_future(loader())
+            self._inflight[key] = load
+            generation = self._generation
+            load.add_done_callback(lambda task: self._loaded(key, task, ttl, generation))
+
+        return await asyncio.shield(load)
+
+    def _loaded(self, key: Hashable, task: asyncio.Future, ttl, generation: int) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if generation != self._generation:
+            # invalidated while loading, the value may be stale
+            return
+
+        value = task.result()
+        self.set(key, value, ttl(value) if callable(ttl) else ttl)
+
+
+class VersionedTTLCache(TTLCache):
+    """TTLCache that is cleared when a shared version counter changes.
+
+    Writers call `bump()`, readers call `sync()` which looks at the counter
+    document at most every `check_interval` seconds, so other processes drop
+    their copies too. A `check_interval` of 0 keeps invalidation local.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: float, app_name: str,
+                 collection, doc_id: str, check_interval: float) -> None:
+        super().__init__(name, max_size, ttl, app_name)
+        self.collection = collection
+        self.doc_id = doc_id
+        self.check_interval = check_interval
+        self._version = None
+        self._checked_at = 0.0
+
+    async def sync(self) -> None:
+        now = time.monotonic()
+        if self.check_interval <= 0 or now - self._checked_at < self.check_interval:
+            return
+
+        # set first, concurrent readers should not all check
+        self._checked_at = now
+        doc = await self.collection.find_one({'_id': self.doc_id})
+        version = doc['version'] if doc else 0
+        if version != self._version:
+            self.invalidate()
+            self._version = version
+
+    async def bump(self) -> None:
+        self.invalidate()
+        if self.check_interval <= 0:
+            return
+
+        doc = await self.collection.find_one_and_update(
+            {'_id': self.doc_id},
+            {'$inc': {'version': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._version = doc['version']
+        self._checked_at = time.monotonic()
@@ -1,14 +1,71 @@
-import motor.motor_asyncio
-from motor.motor_asyncio import AsyncIOMotorDatabase
+from typing import TYPE_CHECKING
 
 from app.config import Settings, get_settings
+from app.instrumentation import stage
+
+if TYPE_CHECKING:
+    from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 
 settings: Settings = get_settings()
 
 DB_URL = settings.api_db_url
 DB_NAME = settings.api_db_name
 
-client = motor.motor_asyncio.AsyncIOMotorClient(DB_URL)
+# created on first use (in the process that uses it), not at import time
+_client: 'AsyncIOMotorClient | None' = None
+
+
+def get_client() -> 'AsyncIOMotorClient':
+    global _client
+    if _client is None:
+        # first use pays for importing motor and building the client
+        with stage('db_client_init'):
+            import motor.motor_asyncio
+
+            event_listeners = []
+            if settings.api_db_monitoring:
+                from app.db_monitoring import (CommandMetricsListener,
+                                               PoolMetricsListener)
+                event_listeners = [
+                    CommandMetricsListener(settings.app_name, settings.api_db_slow_command_ms),
+                    PoolMetricsListener(settings.app_name, settings.api_db_max_pool_size),
+                ]
+
+            _client = motor.motor_asyncio.AsyncIOMotorClient(
+                DB_URL,
+                maxPoolSize=settings.api_db_max_pool_size,
+                minPoolSize=settings.api_db_min_pool_size,
+                waitQueueTimeoutMS=settings.api_db_wait_queue_timeout_ms,
+                serverSelectionTimeoutMS=settings.api_db_server_selection_timeout_ms,
+                event_listeners=event_listeners,
+            )
+
+    return _client
+
+
+def get_db() -> 'AsyncIOMotorDatabase':
+    return get_client()[DB_NAME]
+
+
+class _LazyCollection:
+    # stands in for a motor collection until it is first used
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._collection = None
+
+    def __getattr__(self, attr: str):
+        if self._collection is None:
+            self._collection = get_db()[self.name]
+
+        return getattr(self._collection, attr)
+
+
+class _LazyDatabase:
+    def __getitem__(self, name: str) -> _LazyCollection:
+        return _LazyCollection(name)
+
+    def __getattr__(self, attr: str):
+        return getattr(get_db(), attr)
 
-db: AsyncIOMotorDatabase = client[DB_NAME]
 
+db = _LazyDatabase()
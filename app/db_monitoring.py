@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from pymongo import monitoring
+
+
+#
+# MongoDB command and connection pool metrics (pymongo event listeners)
+#
+
+COMMAND_DURATION = Histogram(
+    "mongodb_command_duration_seconds",
+    "Histogram of MongoDB command time by collection and command (in seconds)",
+    ["collection", "command", "app_name"],
+)
+COMMAND_FAILURES = Counter(
+    "mongodb_command_failures_total",
+    "Total count of failed MongoDB commands by collection and command.",
+    ["collection", "command", "app_name"],
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "mongodb_pool_checkout_wait_seconds",
+    "Histogram of time spent waiting for a pooled connection (in seconds)",
+    ["address", "app_name"],
+)
+POOL_CHECKOUT_FAILURES = Counter(
+    "mongodb_pool_checkout_failures_total",
+    "Total count of failed connection checkouts by reason.",
+    ["address", "reason", "app_name"],
+)
+POOL_CONNECTIONS = Gauge(
+    "mongodb_pool_connections",
+    "Number of open pooled connections.",
+    ["address", "app_name"],
+    multiprocess_mode="livesum",
+)
+POOL_CHECKED_OUT = Gauge(
+    "mongodb_pool_checked_out_connections",
+    "Number of pooled connections currently in use.",
+    ["address", "app_name"],
+    multiprocess_mode="livesum",
+)
+POOL_UTILIZATION = Gauge(
+    "mongodb_pool_utilization_ratio",
+    "Connections in use divided by the maximum pool size.",
+    ["address", "app_name"],
+    multiprocess_mode="livemax",
+)
+
+
+def _address(address) -> str:
+    host, port = address
+    return f'{host}:{port}'
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    def __init__(self, app_name: str, slow_command_ms: float) -> None:
+        self.app_name = app_name
+        self.slow_command_ms = slow_command_ms
+        # (connection, request id) -> collection, only the started event carries the command
+        self._collections: dict[tuple, str] = {}
+
+    @staticmethod
+    def _collection(event: monitoring.CommandStartedEvent) -> str:
+        # e.g. {'find': 'packets', ...}, {'getMore': <id>, 'collection': 'packets'}
+        name = event.command.get(event.command_name)
+        if not isinstance(name, str):
+            name = event.command.get('collection', '')
+        return name if isinstance(name, str) else ''
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self._collections[(event.connection_id, event.request_id)] = self._collection(event)
+
+    def _finished(self, event) -> tuple[str, float]:
+        collection = self._collections.pop((event.connection_id, event.request_id), '')
+        duration = event.duration_micros / 1e6
+        COMMAND_DURATION.labels(collection=collection, command=event.command_name,
+                                app_name=self.app_name).observe(duration)
+
+        if duration * 1000 >= self.slow_command_ms:
+            logging.warning(f'Slow MongoDB command {event.command_name} on "{collection}": {duration * 1000:.0f} ms')
+
+        return collection, duration
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finished(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        collection, _ = self._finished(event)
+        COMMAND_FAILURES.labels(collection=collection, command=event.command_name,
+                                app_name=self.app_name).inc()
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    def __init__(self, app_name: str, max_pool_size: int) -> None:
+        self.app_name = app_name
+        self.max_pool_size = max_pool_size
+        # checkouts happen on the driver's worker threads, start times per thread
+        self._checkout_started = threading.local()
+        self._checked_out: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _in_use(self, address: str, delta: int) -> None:
+        with self._lock:
+            in_use = self._checked_out[address] = self._checked_out.get(address, 0) + delta
+        POOL_CHECKED_OUT.labels(address=address, app_name=self.app_name).set(in_use)
+        if self.max_pool_size:
+            POOL_UTILIZATION.labels(address=address, app_name=self.app_name).set(in_use / self.max_pool_size)
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_created(self, event) -> None:
+        POOL_CONNECTIONS.labels(address=_address(event.address), app_name=self.app_name).inc()
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        POOL_CONNECTIONS.labels(address=_address(event.address), app_name=self.app_name).dec()
+
+    def connection_check_out_started(self, event) -> None:
+        self._checkout_started.value = time.perf_counter()
+
+    def _waited(self, address: str) -> None:
+        started = getattr(self._checkout_started, 'value', None)
+        if started is not None:
+            POOL_CHECKOUT_WAIT.labels(address=address, app_name=self.app_name).observe(time.perf_counter() - started)
+            self._checkout_started.value = None
+
+    def connection_check_out_failed(self, event) -> None:
+        address = _address(event.address)
+        self._waited(address)
+        POOL_CHECKOUT_FAILURES.labels(address=address, reason=str(event.reason), app_name=self.app_name).inc()
+
+    def connection_checked_out(self, event) -> None:
+        address = _address(event.address)
+        self._waited(address)
+        self._in_use(address, 1)
+
+    def connection_checked_in(self, event) -> None:
+        self._in_use(_address(event.address), -1)
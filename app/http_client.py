@@ -0,0 +1,58 @@
+import logging
+
+import httpx
+
+from app.config import Settings
+
+
+#
+# Shared outbound HTTP client (auth and maps servers)
+#
+# One connection pool per process, opened on startup and closed on shutdown,
+# so requests to other services reuse kept-alive connections.
+#
+
+_client: httpx.AsyncClient | None = None
+
+
+def create_http_client(settings: Settings) -> httpx.AsyncClient:
+    http2 = settings.http2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.warning('HTTP/2 requested but the "h2" package is not installed, using HTTP/1.1')
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=settings.http_max_connections,
+            max_keepalive_connections=settings.http_max_keepalive_connections,
+            keepalive_expiry=settings.http_keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            settings.http_read_timeout,
+            connect=settings.http_connect_timeout,
+        ),
+    )
+
+
+def start_http_client(settings: Settings) -> None:
+    global _client
+    if _client is None:
+        _client = create_http_client(settings)
+
+
+async def close_http_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError('HTTP client is not running')
+
+    return _client
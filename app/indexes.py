@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import sys
+
+from pymongo import IndexModel
+from pymongo.errors import PyMongoError
+
+from app.db import db
+
+
+#
+# Declarative index management
+#
+# Modules declare the indexes of their collections and the shapes of their
+# hot queries. Indexes are created (idempotently) in the background on startup,
+# the hot queries can be checked for collection scans with:
+#
+#   python -m app.indexes
+#
+
+# collection name -> index specs
+INDEXES: dict[str, list[IndexModel]] = {}
+
+# (collection name, query name, filter, sort)
+HOT_QUERIES: list[tuple[str, str, dict, list | None]] = []
+
+
+def declare_indexes(collection: str, *indexes: IndexModel) -> None:
+    INDEXES.setdefault(collection, []).extend(indexes)
+
+
+def declare_hot_query(collection: str, name: str, filter: dict, sort: list | None = None) -> None:
+    HOT_QUERIES.append((collection, name, filter, sort))
+
+
+async def create_indexes() -> None:
+    for collection, indexes in INDEXES.items():
+        try:
+            names = await db[collection].create_indexes(indexes)
+            logging.info(f'Indexes on "{collection}": {", ".join(names)}')
+        except PyMongoError as e:
+            logging.warning(f'Could not create indexes on "{collection}": {e}')
+
+
+def _stages(plan: dict):
+    yield plan.get('stage')
+    if 'inputStage' in plan:
+        yield from _stages(plan['inputStage'])
+    for child in plan.get('inputStages', []):
+        yield from _stages(child)
+
+
+async def explain_hot_queries() -> list[tuple[str, str, list[str]]]:
+    """Winning plan stages of every hot query, as (collection, name, stages)."""
+    results = []
+    for collection, name, filter, sort in HOT_QUERIES:
+        cursor = db[collection].find(filter)
+        if sort:
+            cursor = cursor.sort(sort)
+        explained = await cursor.explain()
+        stages = list(_stages(explained['queryPlanner']['winningPlan']))
+        results.append((collection, name, stages))
+
+    return results
+
+
+async def _main() -> int:
+    # register the declarations of every router
+    import app.app  # noqa: F401
+
+    # run as `python -m`, this module is __main__ and the routers declared
+    # into the imported app.indexes, a separate module object
+    from app import indexes as registry
+
+    await registry.create_indexes()
+
+    collscans = 0
+    for collection, name, stages in await registry.explain_hot_queries():
+        flag = 'COLLSCAN' in stages
+        collscans += flag
+        print(f'{"!!" if flag else "ok"} {collection}.{name}: {" <- ".join(stages)}')
+
+    return 1 if collscans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(_main()))
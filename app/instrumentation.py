@@ -0,0 +1,79 @@
+import functools
+import inspect
+import time
+
+from opentelemetry import trace
+from prometheus_client import Histogram
+
+from app.config import get_settings
+
+
+#
+# Per-stage instrumentation
+#
+# Times a processing stage (auth call, db query, maps matrix, optimizer, ...)
+# into a labelled histogram and a span of the same name:
+#
+#   with stage('maps_matrix'):              # or `async with`
+#       ...
+#
+#   @stage('auth_profile')                  # sync or async functions
+#   async def fetch(...): ...
+#
+
+STAGE_DURATION = Histogram(
+    "app_stage_duration_seconds",
+    "Histogram of processing stage time by stage (in seconds)",
+    ["stage", "app_name"],
+)
+PAYLOAD_SIZE = Histogram(
+    "app_payload_size",
+    "Histogram of payload sizes by payload (number of items)",
+    ["payload", "app_name"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000, float("inf")),
+)
+
+tracer = trace.get_tracer(__name__)
+
+
+class stage:
+    def __init__(self, name: str, **attributes) -> None:
+        self.name = name
+        self.attributes = attributes
+        self._histogram = STAGE_DURATION.labels(stage=name, app_name=get_settings().app_name)
+
+    def __enter__(self) -> trace.Span:
+        self._span_cm = tracer.start_as_current_span(self.name, attributes=self.attributes)
+        span = self._span_cm.__enter__()
+        self._start = time.perf_counter()
+        return span
+
+    def __exit__(self, exc_type, exc, tb) -> bool | None:
+        self._histogram.observe(time.perf_counter() - self._start)
+        return self._span_cm.__exit__(exc_type, exc, tb)
+
+    async def __aenter__(self) -> trace.Span:
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool | None:
+        return self.__exit__(exc_type, exc, tb)
+
+    def __call__(self, fn):
+        # a fresh timer per call, the decorator instance is shared
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(self.name, **self.attributes):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(self.name, **self.attributes):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def observe_size(payload: str, size: int) -> None:
+    PAYLOAD_SIZE.labels(payload=payload, app_name=get_settings().app_name).observe(size)
+    trace.get_current_span().set_attribute(f'payload.{payload}', size)
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Literal
+
+from fastapi import HTTPException
+from opentelemetry.propagate import inject
+from pymongo import IndexModel, ReplaceOne
+from pymongo.errors import PyMongoError
+
+from app.auth import credentials_exception
+from app.cache import TTLCache
+from app.config import Settings, get_settings
+from app.db import db
+from app.indexes import declare_indexes
+from app.instrumentation import observe_size, stage
+from app.optimizer.matrix import DistanceMatrix
+from app.resilience import Upstream
+
+
+#
+# Maps server client
+#
+
+TravelMode = Literal[
+    'driving',
+    'walking',
+    'bicycling',
+    'transit'
+]
+
+# tiles have retries of their own (fetch_tile)
+maps_upstream = Upstream(
+    'maps',
+    app_name=get_settings().app_name,
+    failure_threshold=get_settings().upstream_breaker_failures,
+    reset_timeout=get_settings().upstream_breaker_reset,
+    hedge_delay=get_settings().maps_hedge_delay,
+)
+
+
+@stage('maps_request')
+async def fetch_distances(
+    auth_header: str,
+    maps_server_url: str,
+    coords: list[str],
+    mode: TravelMode,
+) -> list[tuple[str, str, int, int]]:
+    # create headers
+    headers = {'Authorization': auth_header}
+
+    # inject trace info to header
+    inject(headers)
+
+    qparams = {
+        'coords': coords,
+        'mode': mode,
+    }
+
+    response = await maps_upstream.get(
+        f'{maps_server_url}/distances/points_list',
+        headers=headers,
+        params=qparams,
+    )
+
+    if response.status_code == 200:
+        # plain tuples, no model per pair (the response has n^2 entries),
+        # the values go into int arrays (app.optimizer.matrix)
+        try:
+            return [
+                (item['p1'], item['p2'], int(item['distance']), int(item['duration']))
+                for item in json.loads(response.content)
+            ]
+        except (KeyError, TypeError, ValueError):
+            raise Exception('Exception while communicating with maps server') from None
+    if response.status_code == 401:
+        raise credentials_exception
+
+    raise Exception('Exception while communicating with maps server')
+
+
+#
+# Distance cache
+#
+# (p1, p2, mode) -> (distance, duration), in memory first and in MongoDB
+# second. Only pairs missing from both are requested from the maps server.
+# In memory one entry is a whole row, (mode, p1) -> {p2: (distance, duration)},
+# so a lookup costs one cache access per location instead of one per pair.
+#
+
+DISTANCES_TABLE = 'distances'
+distances_table = db[DISTANCES_TABLE]
+
+distance_cache = TTLCache(
+    'distances',
+    max_size=get_settings().distance_cache_size,
+    ttl=get_settings().distance_cache_ttl,
+    app_name=get_settings().app_name,
+    # rows grow with every location asked for, cap the number of pairs
+    weigh=lambda row: max(1, len(row)),
+)
+
+
+# matrix rows filled from memory between two event loop yields
+ROWS_PER_YIELD = 64
+
+
+def pair_key(p1: str, p2: str, mode: str) -> str:
+    return f'{mode}|{p1}|{p2}'
+
+
+# let MongoDB drop stale pairs by itself
+declare_indexes(
+    DISTANCES_TABLE,
+    IndexModel('created', expireAfterSeconds=int(get_settings().distance_cache_ttl)),
+)
+
+
+async def load_stored_distances(
+    pairs: list[tuple[str, str]],
+    mode: TravelMode,
+    settings: Settings,
+) -> dict[tuple[str, str], tuple[int, int]]:
+    oldest = datetime.utcnow() - timedelta(seconds=settings.distance_cache_ttl)
+    keys = [pair_key(p1, p2, mode) for p1, p2 in pairs]
+
+    # n^2 keys in one query would exceed the 16 MiB command size for large stores
+    stored = {}
+    batch_size = settings.distance_cache_db_batch_size
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        try:
+            async for doc in distances_table.find({'_id': {'$in': batch}, 'created': {'$gte': oldest}}):
+                stored[(doc['p1'], doc['p2'])] = (doc['distance'], doc['duration'])
+        except PyMongoError as e:
+            # only a cache, the rest is asked from the maps server
+            logging.warning(f'Could not read stored distances: {e}')
+            break
+
+    return stored
+
+
+async def store_distances(
+    distances: dict[tuple[str, str], tuple[int, int]],
+    mode: TravelMode,
+) -> None:
+    created = datetime.utcnow()
+    await distances_table.bulk_write([
+        ReplaceOne(
+            {'_id': pair_key(p1, p2, mode)},
+            {
+                'p1': p1,
+                'p2': p2,
+                'mode': mode,
+                'distance': distance,
+                'duration': duration,
+                'created': created,
+            },
+            upsert=True,
+        )
+        for (p1, p2), (distance, duration) in distances.items()
+    ], ordered=False)
+
+
+#
+# Tiled matrix requests
+#
+# Large coordinate lists are split into blocks. Every tile asks the maps server
+# for the pairs of two blocks (their union), so URLs and responses stay small.
+# Tiles run concurrently, are merged as they arrive and retried on their own.
+#
+
+async def fetch_tile(
+    auth_header: str,
+    maps_server_url: str,
+    coords: list[str],
+    mode: TravelMode,
+    settings: Settings,
+    semaphore: asyncio.Semaphore,
+) -> dict[tuple[str, str], tuple[int, int]]:
+    attempt = 0
+    while True:
+        try:
+            async with semaphore:
+                distances = await fetch_distances(auth_header, maps_server_url, coords, mode)
+
+            return {
+                (p1, p2): (distance, duration)
+                for p1, p2, distance, duration in distances
+                if p1 != p2
+            }
+        except HTTPException:
+            # bad credentials, open circuit or no time left, retrying will not help
+            raise
+        except Exception as e:
+            attempt += 1
+            if attempt > settings.maps_tile_retries:
+                raise
+            logging.warning(f'Maps tile request failed ({e}), retry {attempt}/{settings.maps_tile_retries}')
+            maps_upstream.record_retry()
+            await asyncio.sleep(settings.maps_tile_retry_delay * attempt)
+
+
+async def fetch_distance_tiles(
+    auth_header: str,
+    maps_server_url: str,
+    pairs: list[tuple[str, str]],
+    mode: TravelMode,
+    settings: Settings,
+) -> AsyncIterator[dict[tuple[str, str], tuple[int, int]]]:
+    coords = list(dict.fromkeys(c for pair in pairs for c in pair))
+
+    if len(coords) <= settings.maps_tile_size:
+        tiles = [coords]
+    else:
+        # a tile holds two blocks
+        block_size = max(1, settings.maps_tile_size // 2)
+        block_of = {c: i // block_size for i, c in enumerate(coords)}
+        blocks = [coords[i:i + block_size] for i in range(0, len(coords), block_size)]
+
+        # only the tiles that contain a missing pair
+        needed = sorted({tuple(sorted((block_of[p1], block_of[p2]))) for p1, p2 in pairs})
+        tiles = [blocks[i] if i == j else blocks[i] + blocks[j] for i, j in needed]
+
+    semaphore = asyncio.Semaphore(settings.maps_max_concurrency)
+    tasks = [
+        asyncio.ensure_future(fetch_tile(auth_header, maps_server_url, tile, mode, settings, semaphore))
+        for tile in tiles
+    ]
+
+    try:
+        for next_tile in asyncio.as_completed(tasks):
+            yield await next_tile
+    finally:
+        # a failed tile (or a cancelled request) stops the rest
+        for task in tasks:
+            task.cancel()
+
+
+async def get_distances(
+    auth_header: str,
+    maps_server_url: str,
+    coords: list[str],
+    mode: TravelMode,
+) -> DistanceMatrix:
+    settings = get_settings()
+    matrix = DistanceMatrix(coords)
+
+    # memory tier, rows are shared with the cache and filled in place
+    rows: dict[str, dict[str, tuple[int, int]]] = {}
+    missing = []
+    for i, p1 in enumerate(matrix.locations):
+        if i and i % ROWS_PER_YIELD == 0:
+            # large matrices take a while, let other requests run in between
+            await asyncio.sleep(0)
+        row = distance_cache.get((mode, p1))
+        if row is None:
+            row = {}
+            distance_cache.set((mode, p1), row)
+        rows[p1] = row
+        missing.extend((p1, p2) for p2 in matrix.set_row(p1, row))
+
+    # db tier
+    if missing and settings.distance_cache_persistent:
+        async with stage('db_distance_cache'):
+            stored = await load_stored_distances(missing, mode, settings)
+        for (p1, p2), value in stored.items():
+            rows[p1][p2] = value
+            matrix.set(p1, p2, *value)
+        for p1 in {p1 for p1, _ in stored}:
+            distance_cache.resize((mode, p1))
+        missing = [pair for pair in missing if pair not in stored]
+
+    # maps server, only for the locations of uncached pairs
+    observe_size('maps_missing_pairs', len(missing))
+    if missing:
+        async for fetched in fetch_distance_tiles(auth_header, maps_server_url, missing, mode, settings):
+            for (p1, p2), value in fetched.items():
+                # like matrix.set, pairs outside the matrix are ignored
+                row = rows.get(p1)
+                if row is not None:
+                    row[p2] = value
+                matrix.set(p1, p2, *value)
+            for p1 in {p1 for p1, _ in fetched if p1 in rows}:
+                distance_cache.resize((mode, p1))
+            if fetched and settings.distance_cache_persistent:
+                try:
+                    await store_distances(fetched, mode)
+                except PyMongoError as e:
+                    logging.warning(f'Could not store distances: {e}')
+
+    if not matrix.is_complete():
+        raise Exception('Maps server did not return all distances')
+
+    return matrix
@@ -10,3 +10,8 @@ class JWToken(BaseModel):
 class JWTokenData(BaseModel):
     username: str | None = None
     user_id: UUID
+    # expiry (unix timestamp)
+    exp: int | None = None
+    # role claims (only present if the auth server issues them)
+    is_customer: bool | None = None
+    is_delivery_person: bool | None = None
@@ -1,3 +1,4 @@
+from typing import Literal
 from uuid import UUID
 from pydantic import BaseModel
 
@@ -30,3 +31,52 @@ class PacketUpdate(BaseModel):
 # read-only overrides
 class PacketRead(CommonBaseRead, PacketBase):
     pass
+
+
+# outcome of one packet of a bulk create
+class PacketBulkResult(BaseModel):
+    # position in the request
+    index: int
+    ok: bool
+    id: UUID | None = None
+    error: str | None = None
+
+
+# planned delivery route
+class RouteRead(BaseModel):
+    packets: list[PacketRead]
+    # total travel time in seconds
+    duration: int
+
+
+# one courier of a multi courier plan
+class FleetCourier(BaseModel):
+    time_in_minutes: int
+    # maximum number of packets (None = no limit)
+    max_packets: int | None = None
+
+
+class FleetRouteRequest(BaseModel):
+    store_id: UUID
+    couriers: list[FleetCourier]
+    mode: Literal['driving', 'walking', 'bicycling', 'transit'] = 'driving'
+
+
+# disjoint routes, one per courier in request order
+class FleetRouteRead(BaseModel):
+    routes: list[RouteRead]
+    # packets no courier could take
+    unassigned: list[UUID]
+
+
+# asynchronous route planning job
+class RouteJobRead(CommonBaseRead):
+    # queued, running, done or failed
+    status: str
+    store_id: UUID
+    time_in_minutes: int
+    mode: str
+    # when done
+    result: RouteRead | None = None
+    # when failed
+    error: str | None = None
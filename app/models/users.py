@@ -1,4 +1,4 @@
-from pydantic import EmailStr
+from pydantic import BaseModel, EmailStr
 
 from ._common import CommonBaseRead
 
@@ -10,3 +10,9 @@ class UserRead(CommonBaseRead):
     email: EmailStr
     is_customer: bool = False
     is_delivery_person: bool = False
+
+
+# role flags needed for authorization checks
+class UserRoles(BaseModel):
+    is_customer: bool = False
+    is_delivery_person: bool = False
@@ -0,0 +1,66 @@
+from array import array
+from typing import Iterable, Sequence
+
+
+# value of a pair the maps server has not answered (yet)
+UNKNOWN = -1
+_UNKNOWN_PAIR = (UNKNOWN, UNKNOWN)
+
+
+class DistanceMatrix:
+    """Travel distances and durations between locations, stored row-major in int buffers.
+
+    Locations are interned to integer indices (duplicates share a row), so
+    lookups are plain offsets instead of hashing coordinate strings.
+    """
+
+    def __init__(self, locations: Iterable[str]) -> None:
+        self.locations: list[str] = list(dict.fromkeys(locations))
+        self.index: dict[str, int] = {location: i for i, location in enumerate(self.locations)}
+        self.size = len(self.locations)
+
+        n = self.size
+        self.durations = array('i', [UNKNOWN]) * (n * n)
+        self.distances = array('i', [UNKNOWN]) * (n * n)
+        for i in range(n):
+            self.durations[i * n + i] = 0
+            self.distances[i * n + i] = 0
+
+    def __contains__(self, location: str) -> bool:
+        return location in self.index
+
+    def set(self, p1: str, p2: str, distance: int, duration: int) -> None:
+        # pairs of locations outside the matrix are ignored
+        i = self.index.get(p1)
+        j = self.index.get(p2)
+        if i is None or j is None:
+            return
+
+        offset = i * self.size + j
+        self.distances[offset] = distance
+        self.durations[offset] = duration
+
+    def set_row(self, p1: str, row: dict[str, tuple[int, int]]) -> list[str]:
+        # replace the row of p1 from {p2: (distance, duration)}, returns the
+        # locations the row has no value for
+        i = self.index[p1]
+        base = i * self.size
+        values = [row.get(p2, _UNKNOWN_PAIR) for p2 in self.locations]
+        values[i] = (0, 0)
+
+        self.distances[base:base + self.size] = array('i', [value[0] for value in values])
+        self.durations[base:base + self.size] = array('i', [value[1] for value in values])
+
+        return [p2 for p2, value in zip(self.locations, values) if value is _UNKNOWN_PAIR]
+
+    def duration(self, p1: str, p2: str) -> int:
+        return self.durations[self.index[p1] * self.size + self.index[p2]]
+
+    def distance(self, p1: str, p2: str) -> int:
+        return self.distances[self.index[p1] * self.size + self.index[p2]]
+
+    def is_complete(self) -> bool:
+        return UNKNOWN not in self.durations
+
+    def nodes(self, locations: Sequence[str]) -> list[int]:
+        return [self.index[location] for location in locations]
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+
+from fastapi import HTTPException, Request, status
+
+from app.config import Settings
+
+
+#
+# Route optimizer service
+#
+# CPU heavy optimisation runs in a pool of worker processes so the event loop
+# keeps serving other requests. Jobs are plain picklable problems (see
+# `app.optimizer.solver.RouteProblem`), the workers never touch the app state.
+#
+
+# how often to check whether the client is still connected (seconds)
+DISCONNECT_POLL_INTERVAL = 0.25
+
+
+class ClientDisconnected(Exception):
+    # the client went away while its job was waiting, answered with a 499
+    pass
+
+
+class OptimizerService:
+    def __init__(self) -> None:
+        self._executor: ProcessPoolExecutor | None = None
+        self._workers = 0
+        self._max_queued = 0
+        self._timeout: float | None = None
+        # jobs submitted and not finished yet (running + queued), a timed out
+        # job counts until its worker is done with it
+        self._jobs = 0
+
+    def start(self, settings: Settings) -> None:
+        self._workers = settings.optimizer_workers \
+            or max(1, (os.cpu_count() or 1) // settings.api_workers)
+        self._max_queued = settings.optimizer_max_queued
+        self._timeout = settings.optimizer_job_timeout
+        self._executor = self._create_executor()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # spawn fresh interpreters, forking a process with a running
+        # event loop and db client threads is not safe
+        return ProcessPoolExecutor(
+            max_workers=self._workers,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+
+    async def run(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        request: Request | None = None,
+        timeout: float | None = None,
+    ) -> Any:
+        if self._executor is None:
+            raise RuntimeError('Optimizer service is not running')
+
+        # cap the backlog, a busy service should answer quickly
+        if self._jobs >= self._workers + self._max_queued:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Route optimizer is busy, try again later',
+                headers={'Retry-After': '1'},
+            )
+
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            future = executor.submit(fn, *args)
+            self._jobs += 1
+            future.add_done_callback(lambda _: self._job_done(loop))
+            return await self._wait(asyncio.wrap_future(future), request, timeout or self._timeout)
+        except BrokenProcessPool:
+            # a worker died (e.g. OOM kill), replace the pool for the next jobs,
+            # only once: the other jobs of the broken pool fail here too
+            if self._executor is executor:
+                logging.error('Optimizer process pool is broken, restarting it')
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+            raise
+
+    def _job_done(self, loop: asyncio.AbstractEventLoop) -> None:
+        # called from the pool's thread once the worker is done (or the job
+        # was cancelled before it started)
+        try:
+            loop.call_soon_threadsafe(self._finished)
+        except RuntimeError:
+            # the event loop is closed, nothing left to count
+            pass
+
+    def _finished(self) -> None:
+        self._jobs -= 1
+
+    @staticmethod
+    async def _wait(job: asyncio.Future, request: Request | None, timeout: float | None) -> Any:
+        watcher = asyncio.ensure_future(_wait_disconnect(request)) if request is not None else None
+        waiting = {job} if watcher is None else {job, watcher}
+
+        try:
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+        if job in done:
+            return job.result()
+
+        # cancels the job if it has not started yet, a running job finishes
+        # within its own time limit and its result is dropped
+        job.cancel()
+
+        if watcher is not None and watcher in done:
+            # nobody is waiting for the answer anymore
+            raise ClientDisconnected()
+
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail='Route optimisation timed out',
+        )
+
+
+async def _wait_disconnect(request: Request) -> None:
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+
+optimizer_service = OptimizerService()
+
+
+def get_optimizer_service() -> OptimizerService:
+    return optimizer_service
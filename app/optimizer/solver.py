@@ -0,0 +1,305 @@
+import heapq
+import time
+from array import array
+from dataclasses import dataclass, field
+from typing import Sequence
+
+
+#
+# Single courier route optimisation
+#
+# Nodes are indices into a square, row-major duration matrix of `size` x `size`
+# entries. Node 0 is the depot (the store), every other node is a delivery.
+# A route starts at the depot and ends at its last delivery (no return trip).
+# The best route visits as many deliveries as possible within the budget and,
+# among those, takes the least time.
+#
+
+# end of route marker (an open path has no closing edge)
+END = -1
+
+
+@dataclass
+class RouteProblem:
+    # row-major duration matrix, node 0 is the depot
+    durations: Sequence[int]
+    size: int
+    # maximum route duration
+    budget: int
+    exact_max_nodes: int = 12
+    time_limit: float = 2.0
+    # optional row of `durations` for every node, when the matrix is over
+    # distinct locations and several nodes share one (expanded in the worker)
+    nodes: list[int] | None = None
+    # optional id for every delivery node (node i -> ids[i - 1])
+    ids: list[str] | None = None
+
+
+@dataclass
+class RouteSolution:
+    # delivery nodes in visiting order (depot excluded)
+    order: list[int] = field(default_factory=list)
+    # total travel time of the route
+    duration: int = 0
+    # ids of the visited deliveries in order, if the problem had ids
+    ids: list[str] = field(default_factory=list)
+
+
+def route_duration(durations: Sequence[int], size: int, order: Sequence[int]) -> int:
+    total = 0
+    prev = 0
+    for node in order:
+        total += durations[prev * size + node]
+        prev = node
+
+    return total
+
+
+def solve_exact(durations: Sequence[int], size: int, budget: int) -> RouteSolution:
+    """Held-Karp style DP over subsets of deliveries, O(2^n * n^2)."""
+    n = size - 1
+    if n <= 0:
+        return RouteSolution()
+
+    inf = float('inf')
+    full = 1 << n
+    # cost[mask][j]: shortest path from the depot visiting `mask`, ending at delivery j
+    cost = [[inf] * n for _ in range(full)]
+    parent = [[-1] * n for _ in range(full)]
+
+    for j in range(n):
+        d = durations[j + 1]
+        if d <= budget:
+            cost[1 << j][j] = d
+
+    best_mask, best_last, best_count, best_cost = 0, -1, 0, 0
+    for mask in range(1, full):
+        row = cost[mask]
+        count = mask.bit_count()
+        for j in range(n):
+            c = row[j]
+            if c == inf:
+                continue
+
+            if count > best_count or (count == best_count and c < best_cost):
+                best_mask, best_last, best_count, best_cost = mask, j, count, c
+
+            base = (j + 1) * size + 1
+            for k in range(n):
+                bit = 1 << k
+                if mask & bit:
+                    continue
+                nc = c + durations[base + k]
+                if nc <= budget and nc < cost[mask | bit][k]:
+                    cost[mask | bit][k] = nc
+                    parent[mask | bit][k] = j
+
+    # walk the parents back from the best end state
+    order = []
+    mask, j = best_mask, best_last
+    while j != -1:
+        order.append(j + 1)
+        mask, j = mask ^ (1 << j), parent[mask][j]
+    order.reverse()
+
+    return RouteSolution(order=order, duration=int(best_cost))
+
+
+def solve_heuristic(durations: Sequence[int], size: int, budget: int, time_limit: float) -> RouteSolution:
+    """Cheapest insertion followed by 2-opt / or-opt, the search is bounded by `time_limit` seconds."""
+    deadline = time.monotonic() + time_limit
+
+    def dist(a: int, b: int) -> int:
+        return 0 if b == END else durations[a * size + b]
+
+    route: list[int] = []
+    total = 0
+    unvisited = set(range(1, size))
+
+    while True:
+        # construction is cheap, the time limit is spent on the improvements
+        total = _insert_greedy(route, total, unvisited, dist, budget)
+        improved = _local_search(route, dist, deadline)
+        if improved is None:
+            break
+        # shorter route, there may be room for more deliveries now
+        total = improved
+        if not unvisited or time.monotonic() > deadline:
+            break
+
+    return RouteSolution(order=route, duration=route_duration(durations, size, route))
+
+
+def _insert_greedy(route, total, unvisited, dist, budget) -> int:
+    """Cheapest insertion into `route` (in place), returns the new duration.
+
+    Every node keeps its cheapest insertion as (delta, node the edge starts
+    at) in a heap. An insert splits one edge and adds two: the other nodes
+    only try the two new edges. A node whose best edge was split keeps its old
+    delta as a lower bound and is scanned again only if it comes out on top.
+    """
+    if not unvisited:
+        return total
+
+    # the route as a linked list, edge a -> nxt[a]
+    path = [0] + route
+    nxt = dict(zip(path, path[1:] + [END]))
+
+    def scan(node: int) -> tuple[int, int]:
+        best_delta, best_prev = None, 0
+        a = 0
+        while True:
+            b = nxt[a]
+            delta = dist(a, node) + dist(node, b) - dist(a, b)
+            if best_delta is None or delta < best_delta:
+                best_delta, best_prev = delta, a
+            if b == END:
+                return best_delta, best_prev
+            a = b
+
+    best = {node: scan(node) for node in unvisited}
+    stale = set()
+    heap = [(delta, node, prev) for node, (delta, prev) in best.items()]
+    heapq.heapify(heap)
+
+    while heap:
+        delta, node, prev = heapq.heappop(heap)
+        if best.get(node) != (delta, prev):
+            # inserted already or superseded
+            continue
+        if node in stale:
+            stale.discard(node)
+            delta, prev = best[node] = scan(node)
+            heapq.heappush(heap, (delta, node, prev))
+            continue
+        # the cheapest insertion of all does not fit, none does
+        if total + delta > budget:
+            break
+
+        del best[node]
+        a, b = prev, nxt[prev]
+        nxt[a], nxt[node] = node, b
+        unvisited.discard(node)
+        total += delta
+
+        for other, (other_delta, other_prev) in best.items():
+            before = dist(a, other) + dist(other, node) - dist(a, node)
+            after = dist(node, other) + dist(other, b) - dist(node, b)
+            new_delta, new_prev = (before, a) if before <= after else (after, node)
+            if new_delta < other_delta:
+                # better than every old edge, exact again
+                stale.discard(other)
+                best[other] = (new_delta, new_prev)
+                heapq.heappush(heap, (new_delta, other, new_prev))
+            elif other_prev == a:
+                # its edge is gone, the old delta stays as a lower bound
+                stale.add(other)
+
+    route.clear()
+    a = nxt[0]
+    while a != END:
+        route.append(a)
+        a = nxt[a]
+
+    return total
+
+
+def _local_search(route, dist, deadline) -> int | None:
+    """Improve `route` in place. Returns the new duration or None if nothing improved."""
+    improved_any = False
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = _two_opt(route, dist) or _or_opt(route, dist)
+        improved_any = improved_any or improved
+
+    if not improved_any:
+        return None
+
+    path = [0] + route
+    return sum(dist(a, b) for a, b in zip(path, path[1:]))
+
+
+def _two_opt(route, dist) -> bool:
+    # segment reversal, the matrix may be asymmetric so both directions are tracked
+    path = [0] + route + [END]
+    m = len(path) - 1
+    fwd = [0] * m
+    bwd = [0] * m
+    for t in range(1, m):
+        fwd[t] = fwd[t - 1] + dist(path[t - 1], path[t])
+        bwd[t] = bwd[t - 1] + dist(path[t], path[t - 1])
+
+    for i in range(1, m - 1):
+        for j in range(i + 1, m):
+            old = dist(path[i - 1], path[i]) + (fwd[j] - fwd[i]) + dist(path[j], path[j + 1])
+            new = dist(path[i - 1], path[j]) + (bwd[j] - bwd[i]) + dist(path[i], path[j + 1])
+            if new < old:
+                route[i - 1:j] = reversed(route[i - 1:j])
+                return True
+
+    return False
+
+
+def _or_opt(route, dist) -> bool:
+    # move a chain of up to three deliveries to another position
+    path = [0] + route + [END]
+    m = len(path) - 1
+    for length in (1, 2, 3):
+        for i in range(1, m - length + 1):
+            j = i + length - 1
+            prev, first, last, nxt = path[i - 1], path[i], path[j], path[j + 1]
+            removed = dist(prev, first) + dist(last, nxt) - dist(prev, nxt)
+            for k in range(m):
+                if i - 1 <= k <= j:
+                    continue
+                a, b = path[k], path[k + 1]
+                added = dist(a, first) + dist(last, b) - dist(a, b)
+                if added < removed:
+                    chain = route[i - 1:j]
+                    del route[i - 1:j]
+                    at = k if k < i else k - length
+                    route[at:at] = chain
+                    return True
+
+    return False
+
+
+def solve(
+    durations: Sequence[int],
+    size: int,
+    budget: int,
+    exact_max_nodes: int = 12,
+    time_limit: float = 2.0,
+) -> RouteSolution:
+    # the first leg leaves the depot, nothing fits if no delivery is reachable from it
+    if all(durations[i] > budget for i in range(1, size)):
+        return RouteSolution()
+
+    if size - 1 <= exact_max_nodes:
+        return solve_exact(durations, size, budget)
+
+    return solve_heuristic(durations, size, budget, time_limit)
+
+
+def expand(durations: Sequence[int], size: int, nodes: Sequence[int]) -> array:
+    # node x node matrix from a location x location matrix
+    rows = [durations[i * size:(i + 1) * size] for i in nodes]
+    return array('i', [row[j] for row in rows for j in nodes])
+
+
+def solve_problem(problem: RouteProblem) -> RouteSolution:
+    durations, size = problem.durations, problem.size
+    if problem.nodes is not None:
+        durations, size = expand(durations, size, problem.nodes), len(problem.nodes)
+
+    solution = solve(
+        durations,
+        size,
+        problem.budget,
+        exact_max_nodes=problem.exact_max_nodes,
+        time_limit=problem.time_limit,
+    )
+    if problem.ids is not None:
+        solution.ids = [problem.ids[node - 1] for node in solution.order]
+
+    return solution
@@ -0,0 +1,275 @@
+import heapq
+import time
+from dataclasses import dataclass, field
+from typing import Sequence
+
+from app.optimizer.solver import (END, RouteSolution, _local_search, expand,
+                                  route_duration, solve)
+
+
+#
+# Multi courier route optimisation
+#
+# K couriers leave the same depot (node 0) with their own time budget and an
+# optional limit on the number of deliveries. Every delivery is given to at
+# most one courier. Like the single courier search, the best plan delivers as
+# many packets as possible and, among those, takes the least total time:
+#
+# 1. parallel cheapest insertion over all routes (not bound by the time limit,
+#    like the single courier construction)
+# 2. 2-opt / or-opt within every route (see app.optimizer.solver)
+# 3. relocate and swap deliveries between routes while that shortens the plan,
+#    then try to insert the remaining deliveries again
+#
+
+@dataclass
+class FleetProblem:
+    # row-major duration matrix, node 0 is the depot
+    durations: Sequence[int]
+    size: int
+    # maximum route duration of every courier
+    budgets: list[int]
+    # maximum number of deliveries of every courier (None = no limit)
+    capacities: list[int | None] | None = None
+    # a single courier without a limit is the single courier problem
+    exact_max_nodes: int = 12
+    time_limit: float = 2.0
+    # see RouteProblem
+    nodes: list[int] | None = None
+    ids: list[str] | None = None
+
+
+@dataclass
+class FleetSolution:
+    # one route per courier, in the order of the budgets
+    routes: list[RouteSolution] = field(default_factory=list)
+    # deliveries no courier could take
+    unassigned: list[int] = field(default_factory=list)
+
+
+class _Fleet:
+    def __init__(self, durations, size, budgets, capacities, deadline) -> None:
+        self.durations = durations
+        self.size = size
+        self.budgets = budgets
+        self.capacities = [c if c is not None else size for c in capacities]
+        self.deadline = deadline
+        self.routes: list[list[int]] = [[] for _ in budgets]
+        self.totals = [0] * len(budgets)
+        self.unassigned = set(range(1, size))
+
+    def dist(self, a: int, b: int) -> int:
+        return 0 if b == END else self.durations[a * self.size + b]
+
+    def expired(self) -> bool:
+        return time.monotonic() > self.deadline
+
+    def insert(self) -> None:
+        """Cheapest feasible insertion over every route (see solver._insert_greedy).
+
+        Every (node, route) pair keeps its cheapest insertion as (delta, node
+        the edge starts at) in one heap, an insert only updates the pairs of
+        its route. A pair that does not fit is dropped: its route only gets
+        fuller.
+        """
+        if not self.unassigned:
+            return
+
+        # the routes as linked lists, edge a -> nxt[r][a]
+        nxt = []
+        for route in self.routes:
+            path = [0] + route
+            nxt.append(dict(zip(path, path[1:] + [END])))
+
+        def scan(node: int, r: int) -> tuple[int, int]:
+            best_delta, best_prev = None, 0
+            a = 0
+            while True:
+                b = nxt[r][a]
+                delta = self.dist(a, node) + self.dist(node, b) - self.dist(a, b)
+                if best_delta is None or delta < best_delta:
+                    best_delta, best_prev = delta, a
+                if b == END:
+                    return best_delta, best_prev
+                a = b
+
+        counts = [len(route) for route in self.routes]
+        # per route: node -> (delta, prev)
+        best = [
+            {node: scan(node, r) for node in self.unassigned} if counts[r] < self.capacities[r] else {}
+            for r in range(len(self.routes))
+        ]
+        stale = set()
+        heap = [(delta, node, r, prev) for r, nodes in enumerate(best) for node, (delta, prev) in nodes.items()]
+        heapq.heapify(heap)
+
+        while heap:
+            delta, node, r, prev = heapq.heappop(heap)
+            if best[r].get(node) != (delta, prev):
+                # inserted already, dropped or superseded
+                continue
+            if (node, r) in stale:
+                stale.discard((node, r))
+                delta, prev = best[r][node] = scan(node, r)
+                heapq.heappush(heap, (delta, node, r, prev))
+                continue
+            if self.totals[r] + delta > self.budgets[r]:
+                del best[r][node]
+                continue
+
+            for nodes in best:
+                nodes.pop(node, None)
+            a, b = prev, nxt[r][prev]
+            nxt[r][a], nxt[r][node] = node, b
+            counts[r] += 1
+            self.unassigned.discard(node)
+            self.totals[r] += delta
+            if counts[r] >= self.capacities[r]:
+                best[r].clear()
+
+            for other, (other_delta, other_prev) in best[r].items():
+                before = self.dist(a, other) + self.dist(other, node) - self.dist(a, node)
+                after = self.dist(node, other) + self.dist(other, b) - self.dist(node, b)
+                new_delta, new_prev = (before, a) if before <= after else (after, node)
+                if new_delta < other_delta:
+                    # better than every old edge, exact again
+                    stale.discard((other, r))
+                    best[r][other] = (new_delta, new_prev)
+                    heapq.heappush(heap, (new_delta, other, r, new_prev))
+                elif other_prev == a:
+                    # its edge is gone, the old delta stays as a lower bound
+                    stale.add((other, r))
+
+        for r, route in enumerate(self.routes):
+            route.clear()
+            a = nxt[r][0]
+            while a != END:
+                route.append(a)
+                a = nxt[r][a]
+
+    def improve_routes(self) -> None:
+        for r, route in enumerate(self.routes):
+            total = _local_search(route, self.dist, self.deadline)
+            if total is not None:
+                self.totals[r] = total
+
+    def _removal(self, route: list[int], i: int) -> int:
+        # time saved by taking route[i] out
+        prev = route[i - 1] if i else 0
+        nxt = route[i + 1] if i + 1 < len(route) else END
+        node = route[i]
+        return self.dist(prev, node) + self.dist(node, nxt) - self.dist(prev, nxt)
+
+    def _replacement(self, route: list[int], i: int, node: int) -> int:
+        # extra time when route[i] is replaced by node
+        prev = route[i - 1] if i else 0
+        nxt = route[i + 1] if i + 1 < len(route) else END
+        old = route[i]
+        return self.dist(prev, node) + self.dist(node, nxt) - self.dist(prev, old) - self.dist(old, nxt)
+
+    def relocate(self) -> bool:
+        # move one delivery to the cheapest position of another route
+        for a, route_a in enumerate(self.routes):
+            for i in range(len(route_a)):
+                node = route_a[i]
+                saved = self._removal(route_a, i)
+                # durations need not obey the triangle inequality, a removal may cost time
+                if self.totals[a] - saved > self.budgets[a]:
+                    continue
+                for b, route_b in enumerate(self.routes):
+                    if b == a or len(route_b) >= self.capacities[b]:
+                        continue
+                    room = self.budgets[b] - self.totals[b]
+                    path = [0] + route_b + [END]
+                    for pos in range(1, len(path)):
+                        p, q = path[pos - 1], path[pos]
+                        added = self.dist(p, node) + self.dist(node, q) - self.dist(p, q)
+                        if added <= room and added < saved:
+                            del route_a[i]
+                            route_b.insert(pos - 1, node)
+                            self.totals[a] -= saved
+                            self.totals[b] += added
+                            return True
+
+                if self.expired():
+                    return False
+
+        return False
+
+    def swap(self) -> bool:
+        # exchange two deliveries of different routes
+        for a, route_a in enumerate(self.routes):
+            for b in range(a + 1, len(self.routes)):
+                route_b = self.routes[b]
+                for i in range(len(route_a)):
+                    for j in range(len(route_b)):
+                        delta_a = self._replacement(route_a, i, route_b[j])
+                        delta_b = self._replacement(route_b, j, route_a[i])
+                        if delta_a + delta_b < 0 \
+                                and self.totals[a] + delta_a <= self.budgets[a] \
+                                and self.totals[b] + delta_b <= self.budgets[b]:
+                            route_a[i], route_b[j] = route_b[j], route_a[i]
+                            self.totals[a] += delta_a
+                            self.totals[b] += delta_b
+                            return True
+
+                    if self.expired():
+                        return False
+
+        return False
+
+
+def solve_fleet(
+    durations: Sequence[int],
+    size: int,
+    budgets: list[int],
+    capacities: list[int | None] | None = None,
+    exact_max_nodes: int = 12,
+    time_limit: float = 2.0,
+) -> FleetSolution:
+    unassigned = set(range(1, size))
+    if len(budgets) == 1 and (not capacities or capacities[0] is None):
+        route = solve(durations, size, budgets[0], exact_max_nodes=exact_max_nodes, time_limit=time_limit)
+        return FleetSolution(routes=[route], unassigned=sorted(unassigned.difference(route.order)))
+
+    fleet = _Fleet(durations, size, budgets, capacities or [None] * len(budgets), time.monotonic() + time_limit)
+
+    fleet.insert()
+    fleet.improve_routes()
+    while not fleet.expired():
+        improved = False
+        while not fleet.expired() and (fleet.relocate() or fleet.swap()):
+            improved = True
+        if not improved:
+            break
+        # shorter routes, there may be room for more deliveries now
+        fleet.improve_routes()
+        fleet.insert()
+
+    return FleetSolution(
+        routes=[
+            RouteSolution(order=route, duration=route_duration(durations, size, route))
+            for route in fleet.routes
+        ],
+        unassigned=sorted(fleet.unassigned),
+    )
+
+
+def solve_fleet_problem(problem: FleetProblem) -> FleetSolution:
+    durations, size = problem.durations, problem.size
+    if problem.nodes is not None:
+        durations, size = expand(durations, size, problem.nodes), len(problem.nodes)
+
+    solution = solve_fleet(
+        durations,
+        size,
+        problem.budgets,
+        capacities=problem.capacities,
+        exact_max_nodes=problem.exact_max_nodes,
+        time_limit=problem.time_limit,
+    )
+    if problem.ids is not None:
+        for route in solution.routes:
+            route.ids = [problem.ids[node - 1] for node in route.order]
+
+    return solution
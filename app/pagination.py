@@ -0,0 +1,112 @@
+import base64
+import binascii
+import json
+from typing import TYPE_CHECKING, AsyncIterator, Type
+
+from fastapi import HTTPException, Query, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+from app.config import get_settings
+
+if TYPE_CHECKING:
+    from motor.motor_asyncio import AsyncIOMotorCollection
+
+
+#
+# Keyset pagination on (created, _id)
+#
+# Pages are read in (created, _id) order and the cursor is the key of the last
+# document of the previous page, so every page is an index range scan no
+# matter how deep it is. Documents are projected to the read model fields and
+# sent as stored, without building models for them.
+#
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+SORT = [('created', 1), ('_id', 1)]
+
+
+class PageParams:
+    def __init__(
+        self,
+        limit: int = Query(default=get_settings().page_default_limit, ge=1, le=get_settings().page_max_limit),
+        cursor: str | None = Query(default=None, description=f'Value of the {NEXT_CURSOR_HEADER} header of the previous page'),
+        stream: bool = Query(default=False, description='Stream all remaining documents as NDJSON (ignores limit)'),
+    ):
+        self.limit = limit
+        self.cursor = cursor
+        self.stream = stream
+
+
+def encode_cursor(doc: dict) -> str:
+    raw = json.dumps([doc['created'], doc['_id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        created, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(created), str(id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+
+def after_cursor(query: dict, cursor: str | None) -> dict:
+    if cursor is None:
+        return query
+
+    created, id = decode_cursor(cursor)
+    return {'$and': [query, {'$or': [
+        {'created': {'$gt': created}},
+        {'created': created, '_id': {'$gt': id}},
+    ]}]}
+
+
+def projection(model: Type[BaseModel]) -> dict:
+    return {field.alias: 1 for field in model.__fields__.values()}
+
+
+async def _ndjson(cursor) -> AsyncIterator[bytes]:
+    async for doc in cursor:
+        yield json.dumps(doc, default=str).encode() + b'\n'
+
+
+def _find(collection: 'AsyncIOMotorCollection', query: dict, model: Type[BaseModel], page: PageParams):
+    return collection.find(
+        after_cursor(query, page.cursor),
+        projection(model),
+    ).sort(SORT)
+
+
+async def find_page(
+    collection: 'AsyncIOMotorCollection',
+    query: dict,
+    model: Type[BaseModel],
+    page: PageParams,
+) -> list[dict]:
+    return await _find(collection, query, model, page).limit(page.limit).to_list(page.limit)
+
+
+def page_response(docs: list[dict], page: PageParams) -> JSONResponse:
+    headers = {}
+    if len(docs) == page.limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(docs[-1])
+
+    return JSONResponse(docs, headers=headers)
+
+
+async def paginate(
+    collection: 'AsyncIOMotorCollection',
+    query: dict,
+    model: Type[BaseModel],
+    page: PageParams,
+):
+    if page.stream:
+        return StreamingResponse(
+            _ndjson(_find(collection, query, model, page).batch_size(page.limit)),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+
+    return page_response(await find_page(collection, query, model, page), page)
@@ -0,0 +1,314 @@
+import asyncio
+import contextvars
+import logging
+import math
+import time
+from typing import Awaitable, Callable
+
+import httpx
+from fastapi import HTTPException, status
+from prometheus_client import Counter, Gauge
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.http_client import get_http_client
+
+
+#
+# Outbound call resilience (auth and maps servers)
+#
+# - deadlines: every incoming request gets a time budget (DeadlineMiddleware),
+#   outbound calls only get what is left of it and pass it on
+# - circuit breaker per upstream: after consecutive failures calls fail fast
+#   with a 503 until a trial call gets through again
+# - retries and optional hedging (a second copy sent after a delay) for
+#   idempotent GET requests
+#
+
+DEADLINE_HEADER = 'X-Request-Timeout'
+
+BREAKER_STATE = Gauge(
+    "app_upstream_circuit_state",
+    "State of the upstream circuit breaker (0 closed, 1 half open, 2 open).",
+    ["upstream", "app_name"],
+    multiprocess_mode="livemax",
+)
+UPSTREAM_REJECTED = Counter(
+    "app_upstream_rejected_total",
+    "Total count of upstream calls failed fast by an open circuit breaker.",
+    ["upstream", "app_name"],
+)
+UPSTREAM_FAILURES = Counter(
+    "app_upstream_failures_total",
+    "Total count of failed upstream calls by reason.",
+    ["upstream", "reason", "app_name"],
+)
+UPSTREAM_RETRIES = Counter(
+    "app_upstream_retries_total",
+    "Total count of retried upstream calls.",
+    ["upstream", "app_name"],
+)
+UPSTREAM_HEDGES = Counter(
+    "app_upstream_hedged_requests_total",
+    "Total count of hedged upstream requests by result (sent, won).",
+    ["upstream", "result", "app_name"],
+)
+
+
+#
+# Deadlines
+#
+
+# monotonic time the current request has to be answered by
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar('deadline', default=None)
+
+
+def remaining() -> float | None:
+    # seconds left of the current request budget (None outside of a request)
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class DeadlineMiddleware:
+    # pure ASGI middleware, clients may ask for a shorter budget with the header
+    def __init__(self, app: ASGIApp, timeout: float) -> None:
+        self.app = app
+        self.timeout = timeout
+        self._header = DEADLINE_HEADER.lower().encode()
+
+    def budget(self, scope: Scope) -> float:
+        for name, value in scope["headers"]:
+            if name == self._header:
+                try:
+                    requested = float(value)
+                except ValueError:
+                    break
+                if requested > 0:
+                    return min(requested, self.timeout)
+                break
+
+        return self.timeout
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = _deadline.set(time.monotonic() + self.budget(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _deadline.reset(token)
+
+
+#
+# Circuit breaker
+#
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+    STATE_NAMES = ('closed', 'half open', 'open')
+
+    def __init__(self, name: str, app_name: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        # 0 disables the breaker
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        # a half open breaker lets one trial call through at a time
+        self._trial = False
+        self._state = BREAKER_STATE.labels(upstream=name, app_name=app_name)
+        self._rejected = UPSTREAM_REJECTED.labels(upstream=name, app_name=app_name)
+        self._state.set(self.state)
+
+    def _set(self, state: int) -> None:
+        if state != self.state:
+            logging.warning(f'Circuit breaker of the {self.name} server is {self.STATE_NAMES[state]}')
+        self.state = state
+        self._state.set(state)
+
+    def before_call(self) -> None:
+        if self.state == self.OPEN:
+            wait = self._opened_at + self.reset_timeout - time.monotonic()
+            if wait > 0:
+                self._reject(wait)
+            self._set(self.HALF_OPEN)
+
+        if self.state == self.HALF_OPEN:
+            if self._trial:
+                self._reject(self.reset_timeout)
+            self._trial = True
+
+    def _reject(self, retry_after: float) -> None:
+        self._rejected.inc()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f'The {self.name} server is unavailable, try again later',
+            headers={'Retry-After': str(max(1, math.ceil(retry_after)))},
+        )
+
+    def success(self) -> None:
+        self._failures = 0
+        self._trial = False
+        self._set(self.CLOSED)
+
+    def failure(self) -> None:
+        self._failures += 1
+        self._trial = False
+        if not self.failure_threshold:
+            return
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._set(self.OPEN)
+
+    def cancelled(self) -> None:
+        # nobody waits for the outcome anymore, let the next call try
+        self._trial = False
+
+
+#
+# Upstream client
+#
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Upstream:
+    def __init__(
+        self,
+        name: str,
+        app_name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+        retries: int = 0,
+        retry_delay: float = 0.1,
+        hedge_delay: float | None = None,
+    ) -> None:
+        self.name = name
+        self.breaker = CircuitBreaker(name, app_name, failure_threshold, reset_timeout)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # seconds before a second copy of a GET is sent (None = no hedging)
+        self.hedge_delay = hedge_delay
+        self._app_name = app_name
+        self._retries = UPSTREAM_RETRIES.labels(upstream=name, app_name=app_name)
+        self._hedges = UPSTREAM_HEDGES.labels(upstream=name, result='sent', app_name=app_name)
+        self._hedge_wins = UPSTREAM_HEDGES.labels(upstream=name, result='won', app_name=app_name)
+
+    def record_retry(self) -> None:
+        # for callers with retries of their own (e.g. maps tiles)
+        self._retries.inc()
+
+    def _failure(self, reason: str, breaker: bool = True) -> None:
+        UPSTREAM_FAILURES.labels(upstream=self.name, reason=reason, app_name=self._app_name).inc()
+        if breaker:
+            self.breaker.failure()
+
+    async def _send(self, method: str, url: str, headers: dict | None, **kwargs) -> httpx.Response:
+        timeout = remaining()
+        if timeout is None:
+            # not serving a request, the client timeouts apply
+            return await get_http_client().request(method, url, headers=headers, **kwargs)
+        if timeout <= 0:
+            raise DeadlineExceeded()
+
+        # pass the budget on, the upstream may give up early too
+        headers = {**(headers or {}), DEADLINE_HEADER: f'{timeout:.3f}'}
+        try:
+            return await asyncio.wait_for(
+                get_http_client().request(method, url, headers=headers, **kwargs),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded() from None
+
+    async def _hedged(self, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        tasks = [asyncio.ensure_future(send())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                self._hedges.inc()
+                tasks.append(asyncio.ensure_future(send()))
+
+            # the first good answer wins, otherwise the last outcome
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().status_code < 500:
+                        if task is not tasks[0]:
+                            self._hedge_wins.inc()
+                        return task.result()
+                if not pending:
+                    return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _attempt(self, method: str, url: str, idempotent: bool, **kwargs) -> httpx.Response:
+        self.breaker.before_call()
+        try:
+            if idempotent and self.hedge_delay is not None:
+                response = await self._hedged(lambda: self._send(method, url, **kwargs))
+            else:
+                response = await self._send(method, url, **kwargs)
+        except asyncio.CancelledError:
+            self.breaker.cancelled()
+            raise
+        except DeadlineExceeded:
+            # the budget may have been short to begin with (client header), only
+            # the client timeouts (transport errors) count against the upstream
+            self._failure('deadline', breaker=False)
+            self.breaker.cancelled()
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=f'No answer from the {self.name} server in time',
+            ) from None
+        except httpx.HTTPError as e:
+            # transport errors, undecodable responses, redirect loops, ...
+            self._failure(type(e).__name__)
+            raise
+        except Exception:
+            # not the upstream's fault (e.g. no http client), but a trial call
+            # must not keep the breaker half open for good
+            self.breaker.cancelled()
+            raise
+
+        if response.status_code >= 500:
+            self._failure(str(response.status_code))
+        else:
+            # client errors (401, 404, ...) come from a healthy server
+            self.breaker.success()
+
+        return response
+
+    async def request(self, method: str, url: str, headers: dict | None = None, **kwargs) -> httpx.Response:
+        idempotent = method in ('GET', 'HEAD')
+        retries = self.retries if idempotent else 0
+
+        attempt = 0
+        while True:
+            error = None
+            try:
+                response = await self._attempt(method, url, idempotent, headers=headers, **kwargs)
+                if response.status_code < 500:
+                    return response
+            except httpx.TransportError as e:
+                error = e
+
+            # only retry if the budget allows for it
+            attempt += 1
+            delay = self.retry_delay * attempt
+            left = remaining()
+            if attempt > retries or (left is not None and left <= delay):
+                if error is not None:
+                    raise error
+                return response
+
+            self._retries.inc()
+            await asyncio.sleep(delay)
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+if TYPE_CHECKING:
+    from motor.motor_asyncio import AsyncIOMotorCollection
+
+
+#
+# Route planning jobs
+#
+# Jobs are documents of the `route_jobs` collection, so every api worker (and
+# a restarted one) sees the same queue:
+#
+#   queued -> running -> done | failed
+#
+# Workers claim the oldest queued job with find_one_and_update. A running job
+# holds a lease, jobs of a crashed worker are claimed again once it runs out.
+# While a job is queued or running it carries a `dedupe_key` with a unique
+# (partial) index, identical requests join it instead of adding a new one.
+#
+# Credentials never go to the database: the callers' Authorization headers
+# stay in the memory of the process they were submitted to (the job `owner`),
+# only that process claims the job, and fails its unfinished jobs when it
+# shuts down. With a service credential any process can run any job, jobs cut
+# short by a shutdown are queued again. A job nobody can run anymore (its
+# tokens expired, its owner crashed) fails once it reaches `expires`.
+#
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# overloaded or timed out (optimizer, upstreams), worth another attempt
+RETRY_STATUS_CODES = (503, 504)
+
+# Authorization header and its expiry
+Credential = tuple[str | None, datetime]
+
+
+class RouteJobQueue:
+    def __init__(
+        self,
+        collection: 'AsyncIOMotorCollection',
+        handler: Callable[[dict, str | None], Awaitable[dict]],
+        workers: int,
+        lease: float,
+        poll_interval: float,
+        max_attempts: int,
+        max_wait: float,
+        retry_delay: float = 1.0,
+        service_authorization: str | None = None,
+    ) -> None:
+        self.collection = collection
+        # (job document, authorization) -> result document
+        self.handler = handler
+        self.workers = workers
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        # seconds before a retry, doubled with every attempt
+        self.retry_delay = retry_delay
+        # seconds a job may take from submission to the end
+        self.max_wait = max_wait
+        self.service_authorization = service_authorization
+        # job id -> credentials of the callers waiting for it, oldest first
+        self._credentials: dict[str, list[Credential]] = {}
+        self.worker_id = f'{socket.gethostname()}:{uuid.uuid4().hex[:8]}'
+        self._tasks: set[asyncio.Task] = set()
+        self._running = False
+        # wakes idle workers when a job is submitted to this process
+        self._submitted: asyncio.Event | None = None
+
+    async def submit(
+        self,
+        dedupe_key: str,
+        authorization: str | None,
+        authorization_expires: datetime | None,
+        **params,
+    ) -> dict:
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=self.max_wait)
+        if authorization_expires is not None and not self.service_authorization:
+            # the job cannot run on an expired token
+            expires = min(expires, authorization_expires)
+        credential = (authorization, authorization_expires or expires)
+
+        job = {
+            '_id': str(uuid.uuid4()),
+            'created': now,
+            'updated': now,
+            'status': QUEUED,
+            'attempts': 0,
+            'dedupe_key': dedupe_key,
+            'owner': self.worker_id,
+            'expires': expires,
+            **params,
+        }
+
+        while True:
+            try:
+                await self.collection.insert_one(job)
+                break
+            except DuplicateKeyError:
+                # an identical job is in flight, join it
+                existing = await self.collection.find_one({'dedupe_key': dedupe_key})
+                if existing is not None:
+                    if existing['_id'] in self._credentials:
+                        # a spare credential for the job, it may wait as long as it is valid
+                        self._credentials[existing['_id']].append(credential)
+                        await self.collection.update_one(
+                            {'_id': existing['_id']},
+                            {'$max': {'expires': min(credential[1], existing['created'] + timedelta(seconds=self.max_wait))}},
+                        )
+                    return existing
+                # it just finished, add ours after all
+
+        self._credentials[job['_id']] = [credential]
+
+        if self._submitted is not None:
+            self._submitted.set()
+
+        return job
+
+    async def get(self, job_id: str) -> dict | None:
+        return await self.collection.find_one({'_id': job_id})
+
+    def start(self) -> None:
+        self._submitted = asyncio.Event()
+        self._running = True
+        for _ in range(self.workers):
+            task = asyncio.create_task(self._work())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def stop(self) -> None:
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        try:
+            await self._release_jobs()
+        except Exception as e:
+            # they fail at `expires` (or run again when the lease runs out)
+            logging.warning(f'Could not release route jobs on shutdown: {e}')
+
+    async def _release_jobs(self) -> None:
+        now = datetime.utcnow()
+        if self.service_authorization:
+            # any worker can run them, back to the queue with the jobs cut short
+            await self.collection.update_many(
+                {'worker': self.worker_id, 'status': RUNNING},
+                {
+                    '$set': {'status': QUEUED, 'updated': now},
+                    '$unset': {'worker': '', 'lease_until': ''},
+                },
+            )
+            return
+
+        # the credentials of the jobs submitted here go with this process,
+        # nobody else can run them
+        await self.collection.update_many(
+            {'owner': self.worker_id, 'status': {'$in': [QUEUED, RUNNING]}},
+            {
+                '$set': {
+                    'status': FAILED,
+                    'updated': now,
+                    'finished': now,
+                    'error': 'The server shut down before the job finished, try again',
+                    'status_code': 503,
+                },
+                '$unset': {'dedupe_key': ''},
+            },
+        )
+        self._credentials.clear()
+
+    def _authorization(self, job: dict) -> str | None:
+        now = datetime.utcnow()
+        for authorization, expires in self._credentials.get(job['_id'], []):
+            if expires > now:
+                return authorization
+
+        if self.service_authorization:
+            return self.service_authorization
+
+        raise HTTPException(status_code=401, detail='The credentials of the job have expired')
+
+    async def _claim(self) -> dict | None:
+        now = datetime.utcnow()
+        # jobs run where their credentials are, unless there is a service credential
+        owner = {} if self.service_authorization else {'owner': self.worker_id}
+        return await self.collection.find_one_and_update(
+            {'$or': [
+                # not waiting for a retry ($not also matches jobs without one)
+                {'status': QUEUED, 'not_before': {'$not': {'$gt': now}}, **owner},
+                {'status': RUNNING, 'lease_until': {'$lt': now}, **owner},
+            ]},
+            {
+                '$set': {
+                    'status': RUNNING,
+                    'worker': self.worker_id,
+                    'lease_until': now + timedelta(seconds=self.lease),
+                    'updated': now,
+                },
+                '$inc': {'attempts': 1},
+            },
+            sort=[('created', 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _finish(self, job: dict, status: str, **fields) -> None:
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            # only if nobody else has claimed it in the meantime
+            {'_id': job['_id'], 'worker': self.worker_id, 'status': RUNNING},
+            {
+                '$set': {'status': status, 'updated': now, 'finished': now, **fields},
+                '$unset': {'dedupe_key': ''},
+            },
+        )
+        self._credentials.pop(job['_id'], None)
+
+    async def _expire(self) -> None:
+        # jobs past their time, wherever they were submitted (e.g. by a worker
+        # that has stopped since)
+        now = datetime.utcnow()
+        await self.collection.update_many(
+            {'$or': [
+                {'status': QUEUED, 'expires': {'$lt': now}},
+                {'status': RUNNING, 'expires': {'$lt': now}, 'lease_until': {'$lt': now}},
+            ]},
+            {
+                '$set': {
+                    'status': FAILED,
+                    'updated': now,
+                    'finished': now,
+                    'error': 'The job expired before it could run',
+                    'status_code': 504,
+                },
+                '$unset': {'dedupe_key': ''},
+            },
+        )
+        for job_id, credentials in list(self._credentials.items()):
+            if all(expires < now for _, expires in credentials):
+                del self._credentials[job_id]
+
+    async def _requeue(self, job: dict) -> None:
+        # back off, the optimizer or upstream is busy right now
+        now = datetime.utcnow()
+        delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+        await self.collection.update_one(
+            {'_id': job['_id'], 'worker': self.worker_id, 'status': RUNNING},
+            {
+                '$set': {'status': QUEUED, 'updated': now, 'not_before': now + timedelta(seconds=delay)},
+                '$unset': {'worker': '', 'lease_until': ''},
+            },
+        )
+
+    async def _run(self, job: dict) -> None:
+        if job['attempts'] > self.max_attempts:
+            await self._finish(job, FAILED, error=f'Gave up after {self.max_attempts} attempts')
+            return
+
+        try:
+            result = await self.handler(job, self._authorization(job))
+        except HTTPException as e:
+            if e.status_code in RETRY_STATUS_CODES and job['attempts'] < self.max_attempts:
+                # busy or slow, leave it to the next claim
+                await self._requeue(job)
+                return
+            await self._finish(job, FAILED, error=str(e.detail), status_code=e.status_code)
+        except Exception as e:
+            logging.exception(f'Route job {job["_id"]} failed')
+            await self._finish(job, FAILED, error=str(e) or type(e).__name__)
+        else:
+            await self._finish(job, DONE, result=result)
+
+    async def _work(self) -> None:
+        # the flag too, a cancel racing a wake up can get lost in wait_for
+        while self._running:
+            try:
+                job = await self._claim()
+                if job is None:
+                    await self._expire()
+                    self._submitted.clear()
+                    try:
+                        await asyncio.wait_for(self._submitted.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # db unavailable and the like, try again later
+                logging.warning(f'Route job worker error: {e}')
+                await asyncio.sleep(self.poll_interval)
@@ -1,5 +1,4 @@
 import logging
-from typing import Literal
 from fastapi import APIRouter, Depends, Header
 
 from app.models.jwt import *
@@ -45,49 +44,7 @@ async def list_tasks(
 # Primer klica za 
 #
 
-import httpx
-from opentelemetry.propagate import inject
-
-from app.auth import credentials_exception
-from app.models.examples import DistanceList
-
-
-async def get_distances(
-    auth_header: str,
-    maps_server_url: str,
-    coords: list[str],
-    mode: Literal[
-        'driving',
-        'walking',
-        'bicycling',
-        'transit'
-    ],
-):
-    # create headers
-    headers = { 'Authorization': auth_header }
-
-    # inject trace info to header
-    inject(headers)
-
-    qparams = {
-        'coords': coords,
-        'mode': mode,
-    }
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f'{maps_server_url}/distances/points_list',
-            headers=headers,
-            params = qparams,
-        )
-
-        if response.status_code == 200:
-            distances_str = response.read()
-            return (DistanceList.parse_raw(distances_str)).__root__
-        if response.status_code == 401:
-            raise credentials_exception
-
-    raise Exception('Exception while communicating with maps server')
+from app.maps import get_distances
 
 
 from app.config import Settings, get_settings
@@ -112,4 +69,4 @@ async def get_path(
         ]
     )
 
-    # sedaj imas seznam v "distances"
+    # sedaj imas matriko v "distances" (distances.duration(p1, p2))
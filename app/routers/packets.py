@@ -1,28 +1,79 @@
+from datetime import datetime
 from typing import List
-from typing import Literal
-from fastapi import APIRouter, Depends, HTTPException, Header, Query
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request
 from fastapi.encoders import jsonable_encoder
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import BulkWriteError
 
 from app.db import db
 from app.models.packets import *
 from app.models.jwt import *
-from app.auth import get_current_user, get_current_user_data
-from app.models.users import UserRead
+from app.auth import get_current_user, get_current_user_roles
+from app.models.users import UserRoles
 
-import httpx
-from opentelemetry.propagate import inject
-
-from app.auth import credentials_exception
-from app.models.examples import DistanceList
+from app.maps import TravelMode, get_distances
+from app.pagination import PageParams, paginate, SORT
+from app.indexes import declare_indexes, declare_hot_query
+from app.batching import InsertCoalescer
+from app.instrumentation import stage, observe_size
+from app.admission import AdmissionLimiter
+from app.route_jobs import RouteJobQueue
 
 from app.config import Settings, get_settings
-from app.routers.stores import table as stores_table
-
-import itertools
+from app.routers.stores import load_store
+from app.optimizer.matrix import DistanceMatrix
+from app.optimizer.solver import RouteProblem, solve_problem
+from app.optimizer.vrp import FleetProblem, solve_fleet_problem
+from app.optimizer.service import OptimizerService, get_optimizer_service
 
 TABLE = 'packets'
 table = db[TABLE]
 
+declare_indexes(
+    TABLE,
+    IndexModel('store_id'),
+    IndexModel([('user_id', ASCENDING), ('created', ASCENDING), ('_id', ASCENDING)]),
+    IndexModel([('created', ASCENDING), ('_id', ASCENDING)]),
+)
+declare_hot_query(TABLE, 'by_store', {'store_id': ''})
+declare_hot_query(TABLE, 'list_by_user', {'user_id': ''}, SORT)
+declare_hot_query(TABLE, 'list_all', {}, SORT)
+
+ROUTE_JOBS_TABLE = 'route_jobs'
+
+declare_indexes(
+    ROUTE_JOBS_TABLE,
+    # one in-flight job per (store, budget, mode), the key is removed when it finishes
+    IndexModel('dedupe_key', unique=True, partialFilterExpression={'dedupe_key': {'$exists': True}}),
+    IndexModel([('status', ASCENDING), ('created', ASCENDING)]),
+    # finished jobs are kept for polling a while
+    IndexModel('finished', expireAfterSeconds=int(get_settings().route_job_ttl)),
+)
+declare_hot_query(ROUTE_JOBS_TABLE, 'claim', {'status': ''}, [('created', ASCENDING)])
+
+# group commit of concurrent single creates
+packet_inserts = InsertCoalescer(
+    table,
+    window=get_settings().packet_insert_window,
+    max_batch=get_settings().packet_insert_max_batch,
+)
+
+# expensive endpoints, shed load instead of starving the cheap ones
+route_admission = AdmissionLimiter(
+    'request_route',
+    app_name=get_settings().app_name,
+    max_concurrency=get_settings().route_max_concurrency,
+    max_queued=get_settings().route_max_queued,
+    queue_timeout=get_settings().admission_queue_timeout,
+)
+bulk_admission = AdmissionLimiter(
+    'packets_bulk',
+    app_name=get_settings().app_name,
+    max_concurrency=get_settings().packet_bulk_max_concurrency,
+    max_queued=get_settings().packet_bulk_max_queued,
+    queue_timeout=get_settings().admission_queue_timeout,
+)
+
 
 router = APIRouter(
     prefix='/packets',
@@ -30,7 +81,7 @@ router = APIRouter(
 )
 
 
-async def get_packet(id: str | UUID, token: JWTokenData = Depends(get_current_user), user_data: UserRead = Depends(get_current_user_data)) -> Packet:
+async def get_packet(id: str | UUID, token: JWTokenData = Depends(get_current_user), user_data: UserRoles = Depends(get_current_user_roles)) -> Packet:
     if user_data.is_delivery_person:
         packet = await table.find_one({'_id': str(id)})
 
@@ -44,131 +95,276 @@ async def get_packet(id: str | UUID, token: JWTokenData = Depends(get_current_us
 
 
 @router.post('/', response_model=Packet)
-async def create_packet(*, packet: PacketCreate, token: JWTokenData = Depends(get_current_user), user_data: UserRead = Depends(get_current_user_data)):
+async def create_packet(*, packet: PacketCreate, token: JWTokenData = Depends(get_current_user), user_data: UserRoles = Depends(get_current_user_roles), settings: Settings = Depends(get_settings)):
     if not user_data.is_customer:
         raise Exception("Not Authorised to create packets")
     # create
     packet_db = jsonable_encoder(Packet(**packet.dict(), user_id=token.user_id))
+
+    if settings.packet_insert_coalescing:
+        # written together with other concurrent creates, nothing to read back
+        await packet_inserts.insert(packet_db)
+        return Packet(**packet_db)
+
     new_packet = await table.insert_one(packet_db)
     created_packet = await get_packet(new_packet.inserted_id, token, user_data)
     
     return created_packet
 
 
-@router.get("/request_route", response_model=List[PacketRead])
-async def request_route(store_id: UUID,
-                        time_in_minutes: int,
-                        mode: Literal[
-                                'driving',
-                                'walking',
-                                'bicycling',
-                                'transit'
-                            ] = Query(default='driving'),
-                        user_data: UserRead = Depends(get_current_user_data),
-                        token: JWTokenData = Depends(get_current_user),
-                        authorization: str | None = Header(default=None, include_in_schema=False),
-                        settings: Settings = Depends(get_settings)
+@router.post('/bulk', response_model=List[PacketBulkResult], dependencies=[Depends(bulk_admission)])
+async def create_packets(*,
+    packets: List[PacketCreate],
+    token: JWTokenData = Depends(get_current_user),
+    user_data: UserRoles = Depends(get_current_user_roles),
+    settings: Settings = Depends(get_settings),
 ):
-    time_in_seconds = time_in_minutes * 60
-    
-    # make sure only delivery people can get routes
-    if not user_data.is_delivery_person:
-        raise Exception("Not Authorised to request delivery routes")
+    if not user_data.is_customer:
+        raise HTTPException(status_code=403, detail="Not Authorised to create packets")
+    if len(packets) > settings.packet_bulk_max:
+        raise HTTPException(status_code=413, detail=f"At most {settings.packet_bulk_max} packets per request")
+    if not packets:
+        return []
+
+    # create all in one round trip, no read back
+    packets_db = [jsonable_encoder(Packet(**packet.dict(), user_id=token.user_id)) for packet in packets]
+    results = [PacketBulkResult(index=i, ok=True, id=packet['_id']) for i, packet in enumerate(packets_db)]
+
+    try:
+        await table.insert_many(packets_db, ordered=False)
+    except BulkWriteError as e:
+        # unordered: everything except the failed documents was written
+        for error in e.details.get('writeErrors', []):
+            results[error['index']] = PacketBulkResult(index=error['index'], ok=False, error=error.get('errmsg'))
+
+    return results
+
+
+async def load_route_matrix(
+    store_id: str | UUID,
+    mode: TravelMode,
+    authorization: str | None,
+    settings: Settings,
+) -> tuple[list[dict], DistanceMatrix | None, list[int]]:
+    # packets of the store, their distance matrix and the matrix row of every
+    # node (node 0 is the store, then one node per packet)
 
     # get all packets from store
-    list_of_items = await table.find({"store_id": str(store_id)}).to_list(1000)
+    async with stage('db_find_packets'):
+        list_of_items = await table.find({"store_id": str(store_id)}).to_list(1000)
+    observe_size('route_packets', len(list_of_items))
 
-    if len(list_of_items) < 1: return []
+    if len(list_of_items) < 1: return [], None, []
 
     # get all locations of packets
     coordinates_of_items = [item['delivery_destination'] for item in list_of_items]
 
     # add initial store location
-    store_coordinates = (await stores_table.find_one({"_id": str(store_id)}))['location']
+    store = await load_store(store_id)
+    if not store:
+        raise HTTPException(status_code=404, detail='Store not found')
+    store_coordinates = store['location']
 
     # get distances
-    all_distances = await get_distances(
-        auth_header=authorization,
-        maps_server_url=settings.maps_server,
-        mode=mode,
-        coords=[store_coordinates]+coordinates_of_items
+    async with stage('maps_matrix'):
+        matrix = await get_distances(
+            auth_header=authorization,
+            maps_server_url=settings.maps_server,
+            mode=mode,
+            coords=[store_coordinates]+coordinates_of_items
+        )
+    observe_size('matrix_locations', matrix.size)
+
+    # packets may share a location
+    locations = [store_coordinates] + coordinates_of_items
+
+    return list_of_items, matrix, matrix.nodes(locations)
+
+
+async def load_route_packets(ids: list[str]) -> dict[str, dict]:
+    # the packets of planned routes in one query
+    async with stage('db_load_route'):
+        return {
+            packet['_id']: packet
+            async for packet in table.find({'_id': {'$in': ids}})
+        }
+
+
+async def plan_route(
+    store_id: str | UUID,
+    time_in_minutes: int,
+    mode: TravelMode,
+    authorization: str | None,
+    settings: Settings,
+    optimizer: OptimizerService,
+    request: Request | None = None,
+) -> RouteRead:
+    time_in_seconds = time_in_minutes * 60
+
+    list_of_items, matrix, nodes = await load_route_matrix(store_id, mode, authorization, settings)
+    if not list_of_items: return RouteRead(packets=[], duration=0)
+
+    problem = RouteProblem(
+        durations=matrix.durations,
+        size=matrix.size,
+        budget=time_in_seconds,
+        exact_max_nodes=settings.route_exact_max_packets,
+        time_limit=settings.route_heuristic_time_limit,
+        nodes=nodes,
+        ids=[item['_id'] for item in list_of_items],
     )
+    async with stage('optimizer'):
+        solution = await optimizer.run(solve_problem, problem, request=request)
+    observe_size('route_length', len(solution.ids))
 
-    # dictionary of distances
-    distances_dict = {}
-    for item in all_distances:
-        location1 = item.p1
-        location2 = item.p2
-        duration = item.duration
-        distances_dict[(location1, location2)] = duration
+    # return the route in visiting order
+    found = await load_route_packets(solution.ids)
+    result = [found[id] for id in solution.ids if id in found]
 
-    coordinates_of_items2 = []
+    return RouteRead(packets=result, duration=solution.duration)
 
-    for coord in coordinates_of_items:
-        distance = distances_dict[(store_coordinates, coord)]
-        if distance < time_in_seconds:
-            coordinates_of_items2.append(coord)
-    
-    coordinates_of_items = coordinates_of_items2
 
-    options = []
+@router.get("/request_route", response_model=RouteRead, dependencies=[Depends(route_admission)])
+async def request_route(request: Request,
+                        store_id: UUID,
+                        time_in_minutes: int,
+                        mode: TravelMode = Query(default='driving'),
+                        user_data: UserRoles = Depends(get_current_user_roles),
+                        token: JWTokenData = Depends(get_current_user),
+                        authorization: str | None = Header(default=None, include_in_schema=False),
+                        settings: Settings = Depends(get_settings),
+                        optimizer: OptimizerService = Depends(get_optimizer_service),
+):
+    # make sure only delivery people can get routes
+    if not user_data.is_delivery_person:
+        raise Exception("Not Authorised to request delivery routes")
 
-    for L in range(len(coordinates_of_items) + 1):
-        for subset in itertools.combinations(coordinates_of_items, L):
-            path = (store_coordinates,) + subset
-            length = 0
-            for c1, c2 in zip(path, path[1:]):
-                length += distances_dict[(c1, c2)]
+    return await plan_route(store_id, time_in_minutes, mode, authorization, settings, optimizer, request=request)
 
-            if distance < time_in_seconds:
-                options.append((subset, length))
 
-    selected, _ = max(options, key=lambda x: (len(x[0]), x[1]))
+@router.post("/fleet_routes", response_model=FleetRouteRead, dependencies=[Depends(route_admission)])
+async def request_fleet_routes(request: Request,
+                               fleet: FleetRouteRequest,
+                               user_data: UserRoles = Depends(get_current_user_roles),
+                               authorization: str | None = Header(default=None, include_in_schema=False),
+                               settings: Settings = Depends(get_settings),
+                               optimizer: OptimizerService = Depends(get_optimizer_service),
+):
+    if not user_data.is_delivery_person:
+        raise HTTPException(status_code=403, detail="Not Authorised to request delivery routes")
+    if not fleet.couriers:
+        return FleetRouteRead(routes=[], unassigned=[])
+    if len(fleet.couriers) > settings.fleet_max_couriers:
+        raise HTTPException(status_code=413, detail=f"At most {settings.fleet_max_couriers} couriers per request")
+
+    # one matrix for all couriers
+    list_of_items, matrix, nodes = await load_route_matrix(fleet.store_id, fleet.mode, authorization, settings)
+    if not list_of_items:
+        return FleetRouteRead(routes=[RouteRead(packets=[], duration=0) for _ in fleet.couriers], unassigned=[])
+
+    ids = [item['_id'] for item in list_of_items]
+    problem = FleetProblem(
+        durations=matrix.durations,
+        size=matrix.size,
+        budgets=[courier.time_in_minutes * 60 for courier in fleet.couriers],
+        capacities=[courier.max_packets for courier in fleet.couriers],
+        exact_max_nodes=settings.route_exact_max_packets,
+        time_limit=settings.route_heuristic_time_limit,
+        nodes=nodes,
+        ids=ids,
+    )
+    async with stage('optimizer'):
+        solution = await optimizer.run(solve_fleet_problem, problem, request=request)
+    observe_size('fleet_routes_length', sum(len(route.ids) for route in solution.routes))
+
+    found = await load_route_packets([id for route in solution.routes for id in route.ids])
+
+    return FleetRouteRead(
+        routes=[
+            RouteRead(packets=[found[id] for id in route.ids if id in found], duration=route.duration)
+            for route in solution.routes
+        ],
+        unassigned=[ids[node - 1] for node in solution.unassigned],
+    )
 
-    result = []
-    for coord in selected:
-        result.append(await table.find_one({"delivery_destination": str(coord)}))
 
-    return result
+#
+# Route planning jobs
+#
+# POST /packets/routes answers right away with a job, the route is planned by
+# background workers (app.route_jobs) and polled with GET /packets/routes/{id}.
+#
+
+async def run_route_job(job: dict, authorization: str | None) -> dict:
+    route = await plan_route(
+        job['store_id'],
+        job['time_in_minutes'],
+        job['mode'],
+        authorization,
+        get_settings(),
+        get_optimizer_service(),
+    )
+    return jsonable_encoder(route)
+
+
+route_jobs = RouteJobQueue(
+    db[ROUTE_JOBS_TABLE],
+    run_route_job,
+    workers=get_settings().route_job_workers,
+    lease=get_settings().route_job_lease,
+    poll_interval=get_settings().route_job_poll_interval,
+    max_attempts=get_settings().route_job_max_attempts,
+    max_wait=get_settings().route_job_max_wait,
+    retry_delay=get_settings().route_job_retry_delay,
+    service_authorization=get_settings().route_job_service_authorization,
+)
 
 
-async def get_distances(auth_header: str, maps_server_url: str, coords: list[str], mode: Literal['driving', 'walking', 'bicycling', 'transit'],):
-    # create headers
-    headers = {'Authorization': auth_header}
+@router.post('/routes', response_model=RouteJobRead, status_code=202)
+async def create_route_job(store_id: UUID,
+                           time_in_minutes: int,
+                           mode: TravelMode = Query(default='driving'),
+                           token: JWTokenData = Depends(get_current_user),
+                           user_data: UserRoles = Depends(get_current_user_roles),
+                           authorization: str | None = Header(default=None, include_in_schema=False),
+):
+    if not user_data.is_delivery_person:
+        raise HTTPException(status_code=403, detail="Not Authorised to request delivery routes")
+
+    # identical in-flight requests share one job
+    job = await route_jobs.submit(
+        f'{store_id}|{time_in_minutes}|{mode}',
+        authorization,
+        None if token.exp is None else datetime.utcfromtimestamp(token.exp),
+        store_id=str(store_id),
+        time_in_minutes=time_in_minutes,
+        mode=mode,
+    )
 
-    # inject trace info to header
-    inject(headers)
+    return RouteJobRead(**job)
 
-    qparams = {
-        'coords': coords,
-        'mode': mode,
-    }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            f'{maps_server_url}/distances/points_list',
-            headers=headers,
-            params=qparams,
-        )
+@router.get('/routes/{job_id}', response_model=RouteJobRead)
+async def read_route_job(job_id: UUID, user_data: UserRoles = Depends(get_current_user_roles)):
+    if not user_data.is_delivery_person:
+        raise HTTPException(status_code=403, detail="Not Authorised to request delivery routes")
 
-        if response.status_code == 200:
-            distances_str = response.read()
-            return (DistanceList.parse_raw(distances_str)).__root__
-        if response.status_code == 401:
-            raise credentials_exception
+    job = await route_jobs.get(str(job_id))
+    if not job:
+        raise HTTPException(status_code=404, detail='Route job not found')
 
-    raise Exception('Exception while communicating with maps server')
+    return RouteJobRead(**job)
 
 
 @router.get('/', response_model=List[PacketRead])
-async def list_packets(token: JWTokenData = Depends(get_current_user), user_data: UserRead = Depends(get_current_user_data)):
+async def list_packets(token: JWTokenData = Depends(get_current_user), user_data: UserRoles = Depends(get_current_user_roles), page: PageParams = Depends()):
     # delivery person can see all packages
     if user_data.is_delivery_person:
-        return await table.find().to_list(1000)
+        return await paginate(table, {}, PacketRead, page)
 
     # customer can see their packages
     if user_data.is_customer:
-        return await table.find({'user_id': str(token.user_id)}).to_list(1000)
+        return await paginate(table, {'user_id': str(token.user_id)}, PacketRead, page)
     
     # default return (no user role)
     return []
@@ -1,16 +1,49 @@
 from typing import List
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.encoders import jsonable_encoder
+from pymongo import ASCENDING, IndexModel
 
 from app.db import db
 from app.models.stores import *
 from app.models.jwt import *
-from app.auth import get_current_user, get_current_user_data
-from app.models.users import UserRead
+from app.auth import get_current_user, get_current_user_roles
+from app.models.users import UserRoles
+from app.pagination import PageParams, paginate, find_page, page_response, SORT
+from app.indexes import declare_indexes, declare_hot_query
+from app.cache import VersionedTTLCache
+from app.config import get_settings
 
 TABLE = 'stores'
 table = db[TABLE]
 
+declare_indexes(
+    TABLE,
+    IndexModel([('created', ASCENDING), ('_id', ASCENDING)]),
+)
+declare_hot_query(TABLE, 'list_all', {}, SORT)
+
+# stores rarely change: cache documents and list pages, drop them on every write
+store_cache = VersionedTTLCache(
+    'stores',
+    max_size=get_settings().store_cache_size,
+    ttl=get_settings().store_cache_ttl,
+    app_name=get_settings().app_name,
+    collection=db['cache_versions'],
+    doc_id=TABLE,
+    check_interval=get_settings().store_cache_version_check_interval,
+)
+
+
+async def load_store(id: str | UUID) -> dict | None:
+    await store_cache.sync()
+
+    return await store_cache.get_or_load(
+        ('store', str(id)),
+        lambda: table.find_one({'_id': str(id)}),
+        # do not cache misses
+        ttl=lambda store: None if store else 0,
+    )
+
 
 router = APIRouter(
     prefix='/stores',
@@ -18,8 +51,8 @@ router = APIRouter(
 )
 
 
-async def get_store(id: str | UUID, user_data: UserRead = Depends(get_current_user_data)) -> Store:    
-    store = await table.find_one({'_id': str(id)})
+async def get_store(id: str | UUID, user_data: UserRoles = Depends(get_current_user_roles)) -> Store:    
+    store = await load_store(id)
     if not store:
         raise HTTPException(status_code=404, detail=f'Store not found')
 
@@ -29,7 +62,7 @@ async def get_store(id: str | UUID, user_data: UserRead = Depends(get_current_us
 @router.post('/', response_model=StoreRead)
 async def create_store(*,
     store: StoreCreate,
-    user_data: UserRead = Depends(get_current_user_data),
+    user_data: UserRoles = Depends(get_current_user_roles),
     token: JWTokenData = Depends(get_current_user)
 ):
     if not user_data.is_delivery_person:
@@ -37,14 +70,24 @@ async def create_store(*,
     # create
     store_db = jsonable_encoder(Store(**store.dict(), user_id=token.user_id))
     new_store = await table.insert_one(store_db)
+    await store_cache.bump()
     created_store = await get_store(new_store.inserted_id, user_data)
     
     return created_store
 
 
 @router.get('/', response_model=List[StoreRead])
-async def list_stores(user_data: UserRead = Depends(get_current_user_data)):
-    return await table.find().to_list(1000)
+async def list_stores(user_data: UserRoles = Depends(get_current_user_roles), page: PageParams = Depends()):
+    if page.stream:
+        return await paginate(table, {}, StoreRead, page)
+
+    await store_cache.sync()
+    docs = await store_cache.get_or_load(
+        ('page', page.cursor, page.limit),
+        lambda: find_page(table, {}, StoreRead, page),
+    )
+
+    return page_response(docs, page)
 
 
 @router.get('/{id}', response_model=StoreRead)
@@ -53,10 +96,11 @@ async def read_store(store: Store = Depends(get_store)):
 
 
 @router.patch('/{id}', response_model=StoreRead)
-async def update_store(*, user_data: UserRead = Depends(get_current_user_data), store: Store = Depends(get_store), store_update: StoreUpdate):
+async def update_store(*, user_data: UserRoles = Depends(get_current_user_roles), store: Store = Depends(get_store), store_update: StoreUpdate):
     # update store
     store_update = store_update.dict(exclude_unset=True)
     await table.update_one({'_id': str(store.id)}, {'$set': store_update})
+    await store_cache.bump()
     
     return await get_store(store.id, user_data)
 
@@ -64,11 +108,12 @@ async def update_store(*, user_data: UserRead = Depends(get_current_user_data),
 @router.delete('/{id}')
 async def delete_store(
     store: Store = Depends(get_store),
-    user_data: UserRead = Depends(get_current_user_data), token: JWTokenData = Depends(get_current_user),
+    user_data: UserRoles = Depends(get_current_user_roles), token: JWTokenData = Depends(get_current_user),
 ):
     if not user_data.is_delivery_person:
         raise HTTPException(status=422, detail="Not Authorised to delete stores")
 
     await table.delete_one({'_id': str(store.id)})
+    await store_cache.bump()
 
     return {'ok': True}
@@ -1,16 +1,27 @@
 from typing import List
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.encoders import jsonable_encoder
+from pymongo import ASCENDING, IndexModel
 
 from app.db import db
 from app.models.tasks import *
 from app.models.jwt import *
 from app.auth import get_current_user
+from app.pagination import PageParams, paginate, SORT
+from app.indexes import declare_indexes, declare_hot_query
 
 
 TABLE = 'tasks'
 table = db[TABLE]
 
+# lookups by (_id, user_id) are served by the _id index
+declare_indexes(
+    TABLE,
+    IndexModel([('user_id', ASCENDING), ('created', ASCENDING), ('_id', ASCENDING)]),
+)
+declare_hot_query(TABLE, 'by_id_and_user', {'_id': '', 'user_id': ''})
+declare_hot_query(TABLE, 'list_by_user', {'user_id': ''}, SORT)
+
 
 router = APIRouter(
     prefix='/tasks',
@@ -40,8 +51,8 @@ async def create_task(*, task: TaskCreate, token: JWTokenData = Depends(get_curr
 
 
 @router.get('/', response_model=List[TaskRead])
-async def list_tasks(token: JWTokenData = Depends(get_current_user)):
-    return await table.find({'user_id': str(token.user_id)}).to_list(1000)
+async def list_tasks(token: JWTokenData = Depends(get_current_user), page: PageParams = Depends()):
+    return await paginate(table, {'user_id': str(token.user_id)}, TaskRead, page)
 
 
 @router.get('/{id}', response_model=TaskRead)
@@ -0,0 +1,88 @@
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter
+from opentelemetry.sdk.trace.sampling import (Decision, ParentBased, Sampler,
+                                              SamplingResult,
+                                              TraceIdRatioBased)
+from opentelemetry.trace import StatusCode, get_current_span
+from prometheus_client import Counter
+
+
+#
+# Trace sampling and export (imported lazily from app.utils.start_otlp)
+#
+
+SPANS_DROPPED = Counter(
+    "otel_spans_dropped_total",
+    "Total count of spans dropped because the export queue was full.",
+    ["app_name"],
+)
+ERROR_SPANS_EXPORTED = Counter(
+    "otel_unsampled_error_spans_total",
+    "Total count of error spans exported although their trace was not sampled.",
+    ["app_name"],
+)
+
+
+class RecordUnsampled(Sampler):
+    """Wraps a sampler so dropped root spans are still recorded (but not sampled).
+
+    Recording lets ErrorExportingSpanProcessor export the root spans (e.g. the
+    request span) that end with an error, whatever the sampling decision of
+    their trace was. Child spans of unsampled traces are dropped as usual, so
+    they cost next to nothing.
+    """
+
+    def __init__(self, sampler: Sampler) -> None:
+        self.sampler = sampler
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None) -> SamplingResult:
+        result = self.sampler.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        parent = get_current_span(parent_context).get_span_context()
+        if result.decision == Decision.DROP and not parent.is_valid:
+            return SamplingResult(Decision.RECORD_ONLY, result.attributes, result.trace_state)
+
+        return result
+
+    def get_description(self) -> str:
+        return f'RecordUnsampled{{{self.sampler.get_description()}}}'
+
+
+def build_sampler(ratio: float, sample_errors: bool) -> Sampler:
+    # new traces are kept with the given probability, child spans follow their parent
+    sampler = ParentBased(TraceIdRatioBased(ratio))
+    if sample_errors and ratio < 1.0:
+        return RecordUnsampled(sampler)
+
+    return sampler
+
+
+class ErrorExportingSpanProcessor(BatchSpanProcessor):
+    """BatchSpanProcessor that counts dropped spans and also exports unsampled error spans."""
+
+    def __init__(self, exporter: SpanExporter, app_name: str, export_errors: bool = True, **kwargs) -> None:
+        super().__init__(exporter, **kwargs)
+        self.export_errors = export_errors
+        self._dropped = SPANS_DROPPED.labels(app_name=app_name)
+        self._errors = ERROR_SPANS_EXPORTED.labels(app_name=app_name)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        sampled = span.context.trace_flags.sampled
+        if not sampled and not (self.export_errors and span.status.status_code is StatusCode.ERROR):
+            return
+
+        # the queue is bounded, adding to a full queue pushes out the oldest span
+        if not self.done and len(self.queue) >= self.max_queue_size:
+            self._dropped.inc()
+
+        if sampled:
+            super().on_end(span)
+            return
+
+        # BatchSpanProcessor skips unsampled spans, queue it the same way it would
+        if self.done:
+            return
+        self._errors.inc()
+        self.queue.appendleft(span)
+        if len(self.queue) >= self.max_export_batch_size:
+            with self.condition:
+                self.condition.notify()
@@ -1,29 +1,27 @@
 # from: https://github.com/blueswen/fastapi-observability/blob/main/fastapi_app/utils.py
+import os
 import time
-from typing import Tuple
+from collections import OrderedDict
+from typing import Dict, Tuple
 
 from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import \
-    OTLPSpanExporter
-from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.logging import LoggingInstrumentor
-from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, multiprocess)
 from prometheus_client.openmetrics.exposition import (CONTENT_TYPE_LATEST,
                                                       generate_latest)
-from starlette.middleware.base import (BaseHTTPMiddleware,
-                                       RequestResponseEndpoint)
 from starlette.requests import Request
 from starlette.responses import Response
 from starlette.routing import Match
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# environment variable of the prometheus multiprocess mode
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
 
 INFO = Gauge(
     "fastapi_app_info", "FastAPI application information.", [
-        "app_name"]
+        "app_name"],
+    multiprocess_mode="livemax",
 )
 REQUESTS = Counter(
     "fastapi_requests_total", "Total count of requests by method and path.", [
@@ -48,82 +46,202 @@ REQUESTS_IN_PROGRESS = Gauge(
     "fastapi_requests_in_progress",
     "Gauge of requests by method and path currently being processed",
     ["method", "path", "app_name"],
+    multiprocess_mode="livesum",
 )
 
 
-class PrometheusMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app: ASGIApp, app_name: str = "fastapi-app") -> None:
-        super().__init__(app)
+class _RouteMetrics:
+    # label children of one (method, path), resolved once
+    def __init__(self, method: str, path: str, app_name: str) -> None:
+        self.method = method
+        self.path = path
+        self.app_name = app_name
+        self.requests = REQUESTS.labels(method=method, path=path, app_name=app_name)
+        self.in_progress = REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=app_name)
+        self.processing_time = REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=app_name)
+        self.responses: Dict[int, Counter] = {}
+
+    def response(self, status_code: int) -> Counter:
+        counter = self.responses.get(status_code)
+        if counter is None:
+            counter = self.responses[status_code] = RESPONSES.labels(
+                method=self.method, path=self.path, status_code=status_code, app_name=self.app_name)
+        return counter
+
+
+class PrometheusMiddleware:
+    # pure ASGI middleware, (method, path) -> route template lookups are cached
+    def __init__(self, app: ASGIApp, app_name: str = "fastapi-app", route_cache_size: int = 4096) -> None:
+        self.app = app
         self.app_name = app_name
+        self.route_cache_size = route_cache_size
+        self._paths: "OrderedDict[Tuple[str, str], Tuple[str, bool]]" = OrderedDict()
+        self._metrics: Dict[Tuple[str, str], _RouteMetrics] = {}
         INFO.labels(app_name=self.app_name).inc()
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        method = request.method
-        path, is_handled_path = self.get_path(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        path, is_handled_path = self.get_path(scope)
 
         if not is_handled_path:
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
+
+        metrics = self._metrics.get((method, path))
+        if metrics is None:
+            metrics = self._metrics[(method, path)] = _RouteMetrics(method, path, self.app_name)
+
+        metrics.in_progress.inc()
+        metrics.requests.inc()
+        status_code = HTTP_500_INTERNAL_SERVER_ERROR
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
 
-        REQUESTS_IN_PROGRESS.labels(
-            method=method, path=path, app_name=self.app_name).inc()
-        REQUESTS.labels(method=method, path=path, app_name=self.app_name).inc()
         before_time = time.perf_counter()
         try:
-            response = await call_next(request)
+            await self.app(scope, receive, send_wrapper)
         except BaseException as e:
             status_code = HTTP_500_INTERNAL_SERVER_ERROR
             EXCEPTIONS.labels(method=method, path=path, exception_type=type(
                 e).__name__, app_name=self.app_name).inc()
             raise e from None
         else:
-            status_code = response.status_code
+            # the whole response, streamed bodies included
             after_time = time.perf_counter()
             # retrieve trace id for exemplar
             span = trace.get_current_span()
             trace_id = trace.format_trace_id(
                 span.get_span_context().trace_id)
 
-            REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=self.app_name).observe(
+            metrics.processing_time.observe(
                 after_time - before_time, exemplar={'TraceID': trace_id}
             )
         finally:
-            RESPONSES.labels(method=method, path=path,
-                             status_code=status_code, app_name=self.app_name).inc()
-            REQUESTS_IN_PROGRESS.labels(
-                method=method, path=path, app_name=self.app_name).dec()
+            metrics.response(status_code).inc()
+            metrics.in_progress.dec()
+
+    def get_path(self, scope: Scope) -> Tuple[str, bool]:
+        key = (scope["method"], scope["path"])
+        cached = self._paths.get(key)
+        if cached is not None:
+            self._paths.move_to_end(key)
+            return cached
 
-        return response
+        resolved = self._match_path(scope)
+        self._paths[key] = resolved
+        if len(self._paths) > self.route_cache_size:
+            self._paths.popitem(last=False)
+
+        return resolved
 
     @staticmethod
-    def get_path(request: Request) -> Tuple[str, bool]:
-        for route in request.app.routes:
-            match, child_scope = route.matches(request.scope)
+    def _match_path(scope: Scope) -> Tuple[str, bool]:
+        for route in scope["app"].routes:
+            match, child_scope = route.matches(scope)
             if match == Match.FULL:
                 return route.path, True
 
-        return request.url.path, False
+        return scope["path"], False
+
+
+def multiprocess_metrics() -> bool:
+    # set by main.py when running several workers
+    return bool(os.environ.get(MULTIPROC_DIR_ENV))
 
 
 def metrics(request: Request) -> Response:
-    return Response(generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+    registry = REGISTRY
+    if multiprocess_metrics():
+        # aggregate the metric files of all workers
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    return Response(generate_latest(registry), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+def mark_metrics_process_dead() -> None:
+    # drop this worker from the live gauges
+    if multiprocess_metrics():
+        multiprocess.mark_process_dead(os.getpid())
+
 
+# the OpenTelemetry SDK, exporter and instrumentors are imported lazily,
+# they are a large part of the import time and unused without a trace endpoint
+_tracer_provider = None
 
-def setting_otlp(app: ASGIApp, app_name: str, endpoint: str, log_correlation: bool = True) -> None:
+
+def setting_otlp(app: ASGIApp, app_name: str, endpoint: str, log_correlation: bool = True, excluded_urls: str = "") -> None:
     # Setting OpenTelemetry
+    # the log format references the trace fields, keep them even without tracing
+    if log_correlation:
+        from opentelemetry.instrumentation.logging import LoggingInstrumentor
+        LoggingInstrumentor().instrument(set_logging_format=True)
+
+    if not endpoint:
+        return
+
+    # instrument at import time, spans go through the global (proxy) tracer
+    # provider that start_otlp sets up in every worker process
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+    FastAPIInstrumentor.instrument_app(app, excluded_urls=excluded_urls or None)
+
+
+def start_otlp(
+    app_name: str,
+    endpoint: str,
+    sample_ratio: float = 1.0,
+    sample_errors: bool = True,
+    max_queue_size: int = 2048,
+    max_export_batch_size: int = 512,
+    schedule_delay_millis: int = 5000,
+) -> None:
+    global _tracer_provider
+
+    # tracing disabled
+    if not endpoint:
+        return
+
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import \
+        OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+
+    from app.tracing import ErrorExportingSpanProcessor, build_sampler
+
     # set the service name to show in traces
     resource = Resource.create(attributes={
         "service.name": app_name,
         "compose_service": app_name
     })
 
-    # set the tracer provider
-    tracer = TracerProvider(resource=resource)
+    # set the tracer provider, its exporter thread belongs to this process
+    tracer = TracerProvider(
+        resource=resource,
+        sampler=build_sampler(sample_ratio, sample_errors),
+    )
     trace.set_tracer_provider(tracer)
 
-    tracer.add_span_processor(BatchSpanProcessor(
-        OTLPSpanExporter(endpoint=endpoint)))
+    tracer.add_span_processor(ErrorExportingSpanProcessor(
+        OTLPSpanExporter(endpoint=endpoint),
+        app_name=app_name,
+        export_errors=sample_errors,
+        max_queue_size=max_queue_size,
+        max_export_batch_size=max_export_batch_size,
+        schedule_delay_millis=schedule_delay_millis,
+    ))
+
+    _tracer_provider = tracer
 
-    if log_correlation:
-        LoggingInstrumentor().instrument(set_logging_format=True)
 
-    FastAPIInstrumentor.instrument_app(app, tracer_provider=tracer)
+def stop_otlp() -> None:
+    # flush pending spans
+    if _tracer_provider is not None:
+        _tracer_provider.shutdown()
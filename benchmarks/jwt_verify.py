@@ -0,0 +1,59 @@
+"""JWT verification benchmark: full decode vs the verified claims cache.
+
+Signs one token with the configured secret and verifies it repeatedly, once
+with a full `python-jose` decode per call and once through the claims cache
+used by `get_current_user`, e.g.:
+
+    python benchmarks/jwt_verify.py --calls 20000 --keys 3
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from jose import jwt  # noqa: E402
+
+from app.auth import (claims_cache, decode_token,  # noqa: E402
+                      load_verification_keys, verify_token)
+from app.config import get_settings  # noqa: E402
+
+
+def timed(fn, token: str, settings, calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn(token, settings)
+    return (time.perf_counter() - start) / calls
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--keys', type=int, default=1, help='number of accepted secrets (rotation)')
+    args = parser.parse_args()
+
+    settings = get_settings().copy(update={
+        'api_previous_secret_keys': [f'previous-secret-{i}' for i in range(args.keys - 1)],
+    })
+    keys = load_verification_keys(settings)
+
+    # worst case during a rotation: signed with the last accepted key
+    token = jwt.encode(
+        {'sub': 'courier', 'user_id': 'bench', 'exp': int(time.time()) + 3600},
+        keys[-1],
+        algorithm=settings.api_jwt_algorithm,
+    )
+
+    claims_cache.invalidate()
+    decode = timed(decode_token, token, settings, args.calls)
+    cached = timed(verify_token, token, settings, args.calls)
+
+    print(f'{len(keys)} verification key(s), {args.calls} calls')
+    print(f'{"decode_token":>14}: {decode * 1e6:8.1f} us/call')
+    print(f'{"verify_token":>14}: {cached * 1e6:8.1f} us/call ({decode / cached:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Startup benchmark: import time of the app with and without tracing.
+
+Every run imports `app.app` in a fresh interpreter with `-X importtime` and
+reports the wall time plus the slowest imports (cumulative), e.g.:
+
+    python benchmarks/startup.py --runs 5 --top 15
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_app(env: dict) -> tuple[float, list[tuple[int, int, str]]]:
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app.app'],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+
+    # "import time:      self [us] |  cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us), int(cumulative_us), name.rstrip()))
+
+    return elapsed, imports
+
+
+def report(label: str, env: dict, runs: int, top: int) -> None:
+    times = []
+    imports = []
+    for _ in range(runs):
+        elapsed, imports = import_app(env)
+        times.append(elapsed)
+
+    print(f'== {label}')
+    print(f'import app.app: median {statistics.median(times) * 1000:.0f} ms, '
+          f'min {min(times) * 1000:.0f} ms over {runs} runs')
+    print(f'{"cumulative [ms]":>16} {"self [ms]":>10}  module')
+    for self_us, cumulative_us, name in sorted(imports, key=lambda i: -i[1])[:top]:
+        print(f'{cumulative_us / 1000:16.1f} {self_us / 1000:10.1f}  {name}')
+    print()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    report('tracing enabled', env, args.runs, args.top)
+
+    env['API_TRACE_URL'] = ''
+    report('tracing disabled (API_TRACE_URL="")', env, args.runs, args.top)
+
+
+if __name__ == '__main__':
+    main()
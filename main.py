@@ -1,5 +1,6 @@
 import uvicorn
 import os
+import shutil
 
 
 abspath = os.path.abspath(__file__)
@@ -10,10 +11,27 @@ from app.config import Settings, get_settings
 settings: Settings = get_settings()
 
 
-from app.app import app
+def prepare_multiprocess_metrics(path: str) -> None:
+    # must happen before prometheus_client is imported anywhere,
+    # workers inherit the environment
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = path
+
 
 if __name__ == "__main__":
     # update uvicorn access logger format
     log_config = uvicorn.config.LOGGING_CONFIG
     log_config["formatters"]["access"]["fmt"] = "%(asctime)s %(levelname)s [%(name)s] [%(filename)s:%(lineno)d] [trace_id=%(otelTraceID)s span_id=%(otelSpanID)s resource.service.name=%(otelServiceName)s] - %(message)s"
-    uvicorn.run(app, host="0.0.0.0", port=settings.api_http_port, log_config=log_config)
+
+    if settings.api_workers > 1:
+        # every worker is a fresh (spawned) process that imports the app and
+        # sets up its own db client, exporter and optimizer pool
+        prepare_multiprocess_metrics(settings.prometheus_multiproc_dir)
+        uvicorn.run("app.app:app", host="0.0.0.0", port=settings.api_http_port, log_config=log_config, workers=settings.api_workers)
+    else:
+        # imported here so optimizer worker processes (spawned, they re-import
+        # this module) do not build their own copy of the app
+        from app.app import app
+
+        uvicorn.run(app, host="0.0.0.0", port=settings.api_http_port, log_config=log_config)
@@ -0,0 +1,49 @@
+import random
+from array import array
+
+from app.optimizer.solver import route_duration, solve, solve_heuristic
+
+
+def euclidean_matrix(n: int, seed: int) -> tuple[array, int]:
+    rng = random.Random(seed)
+    size = n + 1
+    points = [(rng.random() * 1000, rng.random() * 1000) for _ in range(size)]
+    durations = array('i', [
+        int(((xa - xb) ** 2 + (ya - yb) ** 2) ** 0.5)
+        for xa, ya in points
+        for xb, yb in points
+    ])
+    return durations, size
+
+
+def test_heuristic_routes_everything_that_fits():
+    durations, size = euclidean_matrix(300, seed=1)
+
+    solution = solve_heuristic(durations, size, budget=10 ** 9, time_limit=2.0)
+
+    assert sorted(solution.order) == list(range(1, size))
+    assert solution.duration == route_duration(durations, size, solution.order)
+
+
+def test_heuristic_respects_budget():
+    durations, size = euclidean_matrix(300, seed=2)
+
+    solution = solve_heuristic(durations, size, budget=5000, time_limit=0.5)
+
+    assert solution.order
+    assert len(set(solution.order)) == len(solution.order)
+    assert solution.duration == route_duration(durations, size, solution.order) <= 5000
+
+
+def test_heuristic_never_beats_exact():
+    rng = random.Random(3)
+    for _ in range(50):
+        size = rng.randint(2, 9)
+        durations = array('i', [rng.randint(1, 50) if i != j else 0 for i in range(size) for j in range(size)])
+        budget = rng.randint(0, 150)
+
+        exact = solve(durations, size, budget)
+        heuristic = solve_heuristic(durations, size, budget, time_limit=0.2)
+
+        assert heuristic.duration <= budget
+        assert len(heuristic.order) <= len(exact.order)
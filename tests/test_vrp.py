@@ -0,0 +1,54 @@
+import random
+from array import array
+
+from app.optimizer.solver import route_duration
+from app.optimizer.vrp import solve_fleet
+
+from tests.test_solver import euclidean_matrix
+
+
+def assert_valid(solution, durations, size, budgets, capacities=None):
+    assigned = [node for route in solution.routes for node in route.order]
+    # every delivery goes to at most one courier
+    assert len(assigned) == len(set(assigned))
+    assert sorted(assigned + solution.unassigned) == list(range(1, size))
+
+    for r, route in enumerate(solution.routes):
+        assert route.duration == route_duration(durations, size, route.order) <= budgets[r]
+        if capacities and capacities[r] is not None:
+            assert len(route.order) <= capacities[r]
+
+
+def test_fleet_routes_everything_that_fits():
+    durations, size = euclidean_matrix(400, seed=4)
+    budgets = [10 ** 9, 10 ** 9]
+
+    solution = solve_fleet(durations, size, budgets, time_limit=2.0)
+
+    assert not solution.unassigned
+    assert_valid(solution, durations, size, budgets)
+
+
+def test_fleet_respects_budgets_and_capacities():
+    durations, size = euclidean_matrix(400, seed=5)
+    budgets = [6000, 4000, 10 ** 9]
+    capacities = [None, 50, 30]
+
+    solution = solve_fleet(durations, size, budgets, capacities=capacities, time_limit=1.0)
+
+    assert all(route.order for route in solution.routes)
+    assert len(solution.routes[2].order) == 30
+    assert_valid(solution, durations, size, budgets, capacities)
+
+
+def test_fleet_small_instances():
+    rng = random.Random(6)
+    for _ in range(50):
+        size = rng.randint(2, 12)
+        durations = array('i', [rng.randint(1, 50) if i != j else 0 for i in range(size) for j in range(size)])
+        budgets = [rng.randint(0, 150) for _ in range(rng.randint(1, 3))]
+        capacities = [rng.choice([None, 1, 2, 3]) for _ in budgets]
+
+        solution = solve_fleet(durations, size, budgets, capacities=capacities, time_limit=0.2)
+
+        assert_valid(solution, durations, size, budgets, capacities)